@@ -0,0 +1,276 @@
+import bisect, collections, logging, re, threading
+
+# characters that can safely be part of a literal search text, everything else ends the literal
+_LITERAL_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789äöå ')
+_QUANTIFIERS = frozenset('*?')
+# a {m}, {m,} or {m,n} quantifier, any other { is an ordinary character
+_REPEAT = re.compile(r'\{(\d*)(?:,\d*)?\}')
+# an escape with everything it consumes: character codes, named characters and backreference numbers
+_ESCAPE = re.compile(r'\\(?:x\w{0,2}|u\w{0,4}|U\w{0,8}|N\{[^}]*\}|\d+|.?)', re.DOTALL)
+# (?x) makes whitespace in the pattern meaningless
+_VERBOSE = re.compile(r'\(\?[a-zA-Z-]*x')
+# characters re.IGNORECASE matches with a literal character that str.lower() does not turn into it
+_FOLD = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u017f': 's'})
+# length of the description substrings alarms are indexed by
+_GRAM = 3
+
+
+def _required_literal(pattern):
+    """
+    Returns the longest lowercase literal text that appears in every match of the pattern, '' if unknown. Only
+    text outside of groups and character sets counts, and none at all when the pattern has alternatives.
+    """
+    if '|' in pattern or _VERBOSE.search(pattern):
+        return ''
+    runs = []
+    run = []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            # escaped punctuation is not in _LITERAL_CHARS either, \w and friends are classes
+            runs.append(run)
+            run = []
+            i = _ESCAPE.match(pattern, i).end()
+            continue
+        if c == '[':
+            runs.append(run)
+            run = []
+            i += 1
+            if i < len(pattern) and pattern[i] == '^':
+                i += 1
+            if i < len(pattern) and pattern[i] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+            continue
+        repeat = _REPEAT.match(pattern, i) if c == '{' else None
+        if repeat:
+            # the repeated character is optional when it may repeat zero times, the text after it is not next to it
+            if run and not int(repeat.group(1) or 0):
+                run.pop()
+            runs.append(run)
+            run = []
+            i = repeat.end()
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and c.lower() in _LITERAL_CHARS:
+            run.append(c.lower())
+            i += 1
+            continue
+        # the previous character may be optional or repeated zero times
+        if c in _QUANTIFIERS and run:
+            run.pop()
+        runs.append(run)
+        run = []
+        i += 1
+    runs.append(run)
+    return ''.join(max(runs, key=len))
+
+
+def _grams(text):
+    return {text[start:start + _GRAM] for start in range(len(text) - _GRAM + 1)}
+
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class _Alarm:
+
+    __slots__ = ('row', 'user_id', 'description', 'location', 'max_price', 'min_price', 'price_drop_only')
+
+    def __init__(self, row):
+        self.row = row
+        self.user_id = row['UserId']
+        self.description = re.compile(row['SearchPattern'], re.IGNORECASE) if row.get('SearchPattern') else None
+        self.location = re.compile(row['Location'], re.IGNORECASE) if row.get('Location') else None
+        self.max_price = row.get('MaxPrice') or None
+        self.min_price = row.get('MinPrice') or None
+        self.price_drop_only = bool(row.get('PriceDropOnly'))
+
+    def matches(self, item):
+        # plain alarms fire for new listings and price changes, never for an ad that was only bumped
+        if self.price_drop_only:
+            if item.change != 'price_drop':
+                return False
+        elif item.change == 'relist':
+            return False
+        if self.max_price is not None or self.min_price is not None:
+            if not isinstance(item.price, int):
+                return False
+            if self.max_price is not None and not item.price < self.max_price:
+                return False
+            if self.min_price is not None and not item.price > self.min_price:
+                return False
+        if self.description is not None and not self.description.match(item.description):
+            return False
+        if self.location is not None and not self.location.match(item.location):
+            return False
+        return True
+
+
+class AlarmMatcher:
+    """
+    Matches items against all alarms at once. Each alarm is compiled once and gets one bit in the masks of
+    several indexes: the text its SearchPattern requires (by its first characters), the price interval it
+    accepts, the item locations it accepts (worked out once per distinct location) and the kind of change it
+    fires on. The masks of an item are and'ed together, only the alarms left are tested with their regexes.
+    """
+    def __init__(self, alarms):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.alarms = []
+        for row in alarms:
+            try:
+                self.alarms.append(_Alarm(row))
+            except re.error:
+                self.logger.error('invalid alarm {}, skipping'.format(row))
+        everyone = (1 << len(self.alarms)) - 1
+
+        # description: alarms by the least common _GRAM characters of their required text, shorter texts and
+        # patterns without one are checked for every item
+        literals = [_required_literal(alarm.row['SearchPattern']) if alarm.description else ''
+                    for alarm in self.alarms]
+        counts = collections.Counter(gram for literal in literals for gram in _grams(literal))
+        self.by_gram = {}
+        self.short = []
+        self.any_description = 0
+        for i, literal in enumerate(literals):
+            if len(literal) >= _GRAM:
+                gram = min(_grams(literal), key=counts.__getitem__)
+                self.by_gram.setdefault(gram, []).append((literal, 1 << i))
+            elif literal:
+                self.short.append((literal, 1 << i))
+            else:
+                self.any_description |= 1 << i
+
+        # price: alarms accepting a price, for every position of the price among the sorted limits. The limits
+        # are exclusive, so a price equal to a limit has a position of its own.
+        self.bounds = sorted({limit for alarm in self.alarms for limit in (alarm.min_price, alarm.max_price)
+                              if limit is not None})
+        positions = 2 * len(self.bounds) + 1
+        self.any_price = 0
+        starts = [0] * (positions + 1)
+        ends = [0] * (positions + 1)
+        for i, alarm in enumerate(self.alarms):
+            if alarm.min_price is None and alarm.max_price is None:
+                self.any_price |= 1 << i
+            start = 2 * bisect.bisect_left(self.bounds, alarm.min_price) + 2 if alarm.min_price is not None else 0
+            end = 2 * bisect.bisect_left(self.bounds, alarm.max_price) + 1 if alarm.max_price is not None \
+                else positions
+            if start < end:
+                starts[start] |= 1 << i
+                ends[end] |= 1 << i
+        self.by_price = []
+        mask = 0
+        for position in range(positions):
+            mask = (mask & ~ends[position]) | starts[position]
+            self.by_price.append(mask)
+
+        # location: alarms without one accept every item, the others are resolved per distinct location
+        self.any_location = sum(1 << i for i, alarm in enumerate(self.alarms) if alarm.location is None)
+        self.by_location = {}
+
+        # change: price_drop_only alarms fire on price drops only, the others on anything but a relist
+        self.drop_only = sum(1 << i for i, alarm in enumerate(self.alarms) if alarm.price_drop_only)
+        self.by_change = {'price_drop': everyone, 'relist': 0}
+        self.other_change = everyone & ~self.drop_only
+        self.logger.debug('{} alarms, {} by text, {} by price, {} by location'.format(
+            len(self.alarms), len(self.alarms) - bin(self.any_description).count('1'),
+            len(self.alarms) - bin(self.any_price).count('1'), len(self.alarms) - bin(self.any_location).count('1')))
+
+    def __len__(self):
+        return len(self.alarms)
+
+    def _description_mask(self, description):
+        mask = self.any_description
+        text = description.translate(_FOLD).lower() if description else ''
+        for gram in _grams(text):
+            for literal, bit in self.by_gram.get(gram, ()):
+                if literal in text:
+                    mask |= bit
+        for literal, bit in self.short:
+            if literal in text:
+                mask |= bit
+        return mask
+
+    def _price_mask(self, price):
+        if not isinstance(price, int):
+            return self.any_price
+        position = bisect.bisect_left(self.bounds, price)
+        if position < len(self.bounds) and self.bounds[position] == price:
+            return self.by_price[2 * position + 1]
+        return self.by_price[2 * position]
+
+    def _location_mask(self, location):
+        mask = self.by_location.get(location)
+        if mask is None:
+            mask = self.any_location
+            for i, alarm in enumerate(self.alarms):
+                if alarm.location is not None and alarm.location.match(location or ''):
+                    mask |= 1 << i
+            # tori has few distinct locations, this only guards against unbounded growth
+            if len(self.by_location) > 10000:
+                self.by_location.clear()
+            self.by_location[location] = mask
+        return mask
+
+    def candidates(self, item):
+        """
+        Indexes of the alarms that pass every prefilter, in the order of the alarm rows.
+        """
+        mask = self.by_change.get(item.change, self.other_change)
+        if mask:
+            mask &= self._price_mask(item.price)
+        if mask:
+            mask &= self._location_mask(item.location)
+        if mask:
+            mask &= self._description_mask(item.description)
+        return _bits(mask)
+
+    def match(self, items):
+        """
+        Returns (item, alarm row) pairs, at most one per item and user.
+        """
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        matches = []
+        for item in items:
+            users = set()
+            for i in self.candidates(item):
+                alarm = self.alarms[i]
+                if alarm.user_id in users:
+                    continue
+                if alarm.matches(item):
+                    users.add(alarm.user_id)
+                    matches.append((item, alarm.row))
+                elif debug:
+                    self.logger.debug('alarm {} rejected "{}, {}, {} eur"'.format(
+                        alarm.row.get('AlarmId'), item.description, item.location, item.price))
+        return matches
+
+
+_matcher = None
+_matcher_key = None
+_matcher_lock = threading.Lock()
+
+
+def get_matcher(db):
+    """
+    Returns an AlarmMatcher for the current contents of the Alarm table, rebuilt only when the table changes.
+    """
+    global _matcher, _matcher_key
+    alarms = db.get_alarms() or []
+    key = tuple(tuple(sorted(alarm.items())) for alarm in alarms)
+    with _matcher_lock:
+        if _matcher is None or key != _matcher_key:
+            _matcher = AlarmMatcher(alarms)
+            _matcher_key = key
+        return _matcher
@@ -7,6 +7,7 @@ import sys
 import inspect
 import logging
 import logging.handlers
+import multiprocessing
 import stat
 from pathlib import Path
 
@@ -78,14 +79,88 @@ try:
     gmail_pass = config.get('EMAIL', 'gmail_pass')
 except (configparser.NoOptionError, configparser.NoSectionError):
     pass
+smtp_host = config.get('EMAIL', 'smtp_host', fallback='smtp.gmail.com')
+smtp_port = config.getint('EMAIL', 'smtp_port', fallback=587)
+smtp_starttls = config.getboolean('EMAIL', 'smtp_starttls', fallback=True)
+email_digest_window = config.getfloat('EMAIL', 'digest_window', fallback=10)
+email_retries = config.getint('EMAIL', 'retries', fallback=5)
 
 db_conn = config.get('DATABASE', 'db_conn')
-db_user = config.get('DATABASE', 'db_user')
-db_pass = config.get('DATABASE', 'db_pass')
-db_host = config.get('DATABASE', 'db_host')
-db_name = config.get('DATABASE', 'db_name')
+db_user = config.get('DATABASE', 'db_user', fallback='')
+db_pass = config.get('DATABASE', 'db_pass', fallback='')
+db_host = config.get('DATABASE', 'db_host', fallback='')
+db_name = config.get('DATABASE', 'db_name', fallback='')
+db_pool_size = config.getint('DATABASE', 'db_pool_size', fallback=5)
+db_pool_timeout = config.getfloat('DATABASE', 'db_pool_timeout', fallback=30)
+sqlite_path = config.get('DATABASE', 'sqlite_path', fallback='tori.sqlite3')
+write_behind = config.getboolean('DATABASE', 'write_behind', fallback=True)
+write_batch = config.getint('DATABASE', 'write_batch', fallback=1000)
+write_wait = config.getfloat('DATABASE', 'write_wait', fallback=1)
+write_queue = config.getint('DATABASE', 'write_queue', fallback=100000)
+journal_dir = config.get('DATABASE', 'journal_dir', fallback='journal')
+journal_fsync = config.getboolean('DATABASE', 'journal_fsync', fallback=True)
+
+base_url = config.get('SCRAPER', 'base_url', fallback='https://www.tori.fi/')
+fetcher = config.get('SCRAPER', 'fetcher', fallback='urllib').lower()
+fetch_concurrency = config.getint('SCRAPER', 'fetch_concurrency', fallback=10)
+fetch_timeout = config.getfloat('SCRAPER', 'fetch_timeout', fallback=30)
+adaptive_paging = config.getboolean('SCRAPER', 'adaptive_paging', fallback=True)
+rate_limit = config.getfloat('SCRAPER', 'rate_limit', fallback=5)
+rate_limit_min = config.getfloat('SCRAPER', 'rate_limit_min', fallback=0.5)
+rate_limit_max = config.getfloat('SCRAPER', 'rate_limit_max', fallback=50)
+latency_target = config.getfloat('SCRAPER', 'latency_target', fallback=2)
+fetch_retries = config.getint('SCRAPER', 'retries', fallback=3)
+fetch_backoff = config.getfloat('SCRAPER', 'backoff', fallback=1)
+breaker_error_ratio = config.getfloat('SCRAPER', 'breaker_error_ratio', fallback=0.5)
+breaker_window = config.getint('SCRAPER', 'breaker_window', fallback=20)
+breaker_cooldown = config.getfloat('SCRAPER', 'breaker_cooldown', fallback=300)
+detail_cache = config.getboolean('SCRAPER', 'detail_cache', fallback=True)
+detail_cache_dir = config.get('SCRAPER', 'detail_cache_dir', fallback='')
+detail_cache_memory_mb = config.getint('SCRAPER', 'detail_cache_memory_mb', fallback=32)
+detail_cache_disk_mb = config.getint('SCRAPER', 'detail_cache_disk_mb', fallback=512)
+detail_cache_ttl = config.getfloat('SCRAPER', 'detail_cache_ttl', fallback=3600)
+parser_backend = config.get('SCRAPER', 'parser_backend', fallback='bs4').lower()
+parse_workers = config.get('SCRAPER', 'parse_workers', fallback='0').lower()
+parse_workers = os.cpu_count() if parse_workers == 'auto' else int(parse_workers)
+warm_start = config.getboolean('SCRAPER', 'warm_start', fallback=True)
+snapshot_dir = config.get('SCRAPER', 'snapshot_dir', fallback='')
+pipeline = config.getboolean('SCRAPER', 'pipeline', fallback=False)
+pipeline_batch = config.getint('SCRAPER', 'pipeline_batch', fallback=50)
+pipeline_wait = config.getfloat('SCRAPER', 'pipeline_wait', fallback=1)
+pipeline_queue = config.getint('SCRAPER', 'pipeline_queue', fallback=1000)
+
+
+
+def _read_topic(name, parser='tori'):
+    section = 'TOPIC ' + name
+    return {'name': name,
+            'parser': config.get(section, 'parser', fallback=parser).lower(),
+            'path': config.get(section, 'path', fallback=None),
+            'pages': config.getint(section, 'pages', fallback=100),
+            'keep': config.getint(section, 'keep', fallback=8000),
+            'max_age': config.getfloat(section, 'max_age', fallback=0),
+            'min_interval': config.getfloat(section, 'min_interval', fallback=60),
+            'max_interval': config.getfloat(section, 'max_interval', fallback=600),
+            'target_new_items': config.getint(section, 'target_new_items', fallback=40)}
+
+
+# every [TOPIC <name>] section is scraped on its own schedule, cars and all items are scraped when none is given
+topics = [_read_topic(section[len('TOPIC '):]) for section in config.sections() if section.startswith('TOPIC ')]
+if not topics:
+    topics = [_read_topic('autot', parser='car'), _read_topic('koko_suomi')]
+
+# timing of functions marked with profiling.timed, also enabled by the TORI_TIMING environment variable
+profile_timing = config.getboolean('PROFILING', 'timing', fallback=False)
+
+metrics_host = config.get('METRICS', 'host', fallback='127.0.0.1')
+metrics_port = config.getint('METRICS', 'port', fallback=0)
+metrics_log_interval = config.getfloat('METRICS', 'log_interval', fallback=300)
 
 loglevel = config.get('COMMON', 'loglevel')
 
-setup_logging('logs')
+# spawned parse workers import this module too, only the main process writes the log file and redirects stdio
+if multiprocessing.parent_process() is None:
+    setup_logging('logs')
+else:
+    logging.getLogger().addHandler(logging.NullHandler())
 
@@ -1,16 +1,35 @@
 from bs4 import BeautifulSoup
 import urllib.request, urllib.error, urllib.parse
-import re, traceback, logging, datetime, functools
+import re, traceback, logging, datetime, functools, threading
+import concurrent.futures
+import multiprocessing
 import multiprocessing.dummy as mp
 
-from items import ToriItemList, CarItemList, ToriItem
+import config
+import metrics
+import profiling
+from fetcher import FetcherFactory, CircuitBreaker
+from items import ToriItemList, CarItemList, ToriItem, CarItem
+from parser_backends import get_backend
+
+FETCH_SECONDS = metrics.histogram('tori_fetch_seconds', 'Duration of fetching one page', ['kind'])
+FETCH_BYTES = metrics.counter('tori_fetch_bytes_total', 'Bytes of fetched pages', ['kind'])
+FETCH_ERRORS = metrics.counter('tori_fetch_errors_total', 'Pages that could not be fetched', ['kind'])
+PARSE_SECONDS = metrics.histogram('tori_parse_seconds', 'Duration of parsing one listing page', ['parser'])
 
 
 class ToriParser:
 
-    def __init__(self):
+    discarded = re.compile(r'(prisjakt|pp_item|listing_carousel)')
+    accepted = re.compile(r'^item_\d+$')
+    fields = ('toriid', 'description', 'price', 'date', 'imageurl', 'toriurl', 'location', 'buy_or_sell', 'category')
+    item_class = ToriItem
+
+    def __init__(self, backend=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.topic = ''
+        self.backend = get_backend(backend or config.parser_backend)
+        self.executor = None
 
     @staticmethod
     def _get_number(text):
@@ -20,9 +39,9 @@ class ToriParser:
         matches = re.findall(r'\d+', no_ws)
         return int(matches[0]) if matches else None
 
-    def _category_parser(self, soup):
-        if soup is not None:
-            titles = soup['title'].split(',')
+    def _category_parser(self, img):
+        if img is not None:
+            titles = self.backend.attr(img, 'title').split(',')
             titles = list(map(str.strip, titles))
             city = titles[-2]
             category = titles[-3]
@@ -32,45 +51,62 @@ class ToriParser:
     def list_factory(self, *args, **kwargs) -> ToriItemList:
         return ToriItemList(*args, **kwargs)
 
+    def run(self, func, *args):
+        """
+        Runs CPU heavy parsing in the parse process pool when one is configured, otherwise in this thread.
+        """
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+    @profiling.timed
     def parse(self, html) -> ToriItemList:
         if not html:
             return ToriItemList('fail')
-        soup = BeautifulSoup(html, 'html.parser')
-        discarded = re.compile(r'(prisjakt|pp_item|listing_carousel)')
-        accepted = re.compile(r'^item_\d+$')
-
-        rows = soup.body.find_all('a', class_='item_row')
         items = ToriItemList('fetch')
+        with PARSE_SECONDS.time(parser=self.backend.name):
+            for row in self.run(_parse_rows, self.__class__, self.backend.name, html):
+                items.add(self.item_class(**dict(zip(self.fields, row))))
+        return items
+
+    def parse_rows(self, html):
+        """
+        Parses a listing page into plain tuples of self.fields, which are cheap to send between processes.
+        """
+        b = self.backend
+        rows = b.rows(html)
+        parsed = []
         items_total = 0
 
         for row in rows:
             try:
-                if 'id' not in row.attrs:
+                row_id = b.attr(row, 'id')
+                if row_id is None:
                     continue
 
-                if not discarded.match(row.attrs['id']) and accepted.match(row.attrs['id']):
+                if not self.discarded.match(row_id) and self.accepted.match(row_id):
                     items_total += 1
 
-                has_image = row.find('div', class_='sprite_list_no_image') is None
-                numerals = [int(s) for s in row['id'].split('_') if s.isdigit()]
+                has_image = b.find(row, 'div', 'sprite_list_no_image') is None
+                numerals = [int(s) for s in row_id.split('_') if s.isdigit()]
                 if not numerals:
                     continue
-                date_raw = row.find('div', class_='date_image').text.strip()
-                date_processed = re.sub(r'[\t]', '', date_raw)
-                date_processed = re.sub(r'[\n]', ' ', date_processed)
+                date_raw = b.text(b.find(row, 'div', 'date_image')).strip()
+                date_processed = date_raw.replace('\t', '').replace('\n', ' ')
+                img = b.find(row, 'img', 'item_image')
                 item = {
                     'toriid': numerals[0],
-                    'description': row.find('div', class_='li-title').text,
-                    'price': row.find('p', class_='list_price').text,
-                    'date': date_processed,
-                    'imageurl': row.find('img', class_='item_image')['src'] if has_image else None,
-                    'toriurl': row['href']
+                    'description': b.text(b.find(row, 'div', 'li-title')),
+                    'price': b.text(b.find(row, 'p', 'list_price')),
+                    'date': ToriItem._convert_date(date_processed),
+                    'imageurl': b.attr(img, 'src') if has_image else None,
+                    'toriurl': b.attr(row, 'href')
                 }
-                
-                city, category = self._category_parser(row.find('img', class_='item_image'))
-                cat_geo = row.find('div', class_='cat_geo')
-                item['location'] = cat_geo.find_all('p')[0].text.strip() + (', ' + city) if city else ''
-                item['buy_or_sell'] = cat_geo.find_all('p')[1].text.strip()
+
+                city, category = self._category_parser(img)
+                geo = b.find_all(b.find(row, 'div', 'cat_geo'), 'p')
+                item['location'] = b.text(geo[0]).strip() + (', ' + city) if city else ''
+                item['buy_or_sell'] = b.text(geo[1]).strip()
                 item['category'] = category
 
                 try:
@@ -79,15 +115,15 @@ class ToriParser:
                     self.logger.debug('unknown price format: {0}'.format(item['price']))
                     item['price'] = None
 
-                    self.logger.debug('parsed:\n{}\n{}\n\n'.format('-' * 70, row.prettify()))
-                items.add(ToriItem(**item))
+                    self.logger.debug('parsed:\n{}\n{}\n\n'.format('-' * 70, b.dump(row)))
+                parsed.append(tuple(item[field] for field in self.fields))
             except KeyboardInterrupt as e:
                 raise e
             except:
-                self.logger.error('Unable to parse:\n{}\n{}\n\n'.format('-' * 70, row.prettify()))
+                self.logger.error('Unable to parse:\n{}\n{}\n\n'.format('-' * 70, b.dump(row)))
                 self.logger.error('Exception:\n{}'.format(traceback.format_exc()))
-        self.logger.debug('successfully parsed {0}/{1}'.format(len(items), items_total))
-        return items
+        self.logger.debug('successfully parsed {0}/{1}'.format(len(parsed), items_total))
+        return parsed
 
     def enrich(self, url_getter, item: ToriItem):
         return item  # return unmodified
@@ -95,8 +131,10 @@ class ToriParser:
 
 class CarParser(ToriParser):
 
-    def __init__(self):
-        super().__init__()
+    item_class = CarItem
+
+    def __init__(self, backend=None):
+        super().__init__(backend)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.topic = '/autot'
 
@@ -107,9 +145,17 @@ class CarParser(ToriParser):
         return CarItemList.create_from_another_list(super().parse(html))
 
     def enrich(self, url_getter, item: ToriItem):
+        if item.change not in (None, 'new'):
+            # details of a known car were fetched when it was new, persist only updates price and date
+            return item
         html = url_getter(item.toriurl, user_msg=str(item.date))
         if not html:
             return None
+        item.add(**self.run(CarParser.parse_details, html))
+        return item
+
+    @staticmethod
+    def parse_details(html):
         soup = BeautifulSoup(html, 'html.parser')
         det_fin = {}
         for row in soup('td', class_='topic'):
@@ -136,39 +182,133 @@ class CarParser(ToriParser):
         det['car_description_extra'] = sub_topic[0].text if sub_topic else None
         det['car_info'] = soup('div', class_='body')[0].text.strip('\n').strip()
         det['car_info'] = ' '.join([line.strip() for line in det['car_info'].split('\n')])
-        item.add(**det)
-        return item
+        return det
+
+
+@functools.lru_cache(maxsize=None)
+def _parser(parser_class, backend):
+    # one parser per class and backend in every process, parse_rows keeps no state between pages
+    return parser_class(backend)
+
+
+def _parse_rows(parser_class, backend, html):
+    # module level so that it can be sent to the parse process pool
+    return _parser(parser_class, backend).parse_rows(html)
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def parse_pool():
+    """
+    Process pool shared by all parsers, None when parse_workers = 0 and parsing stays in the fetching threads.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None and config.parse_workers:
+            _parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=config.parse_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+
+def close_parse_pool():
+    """
+    Shuts the parse process pool down and waits for its workers to exit. A later parse_pool() starts a new one.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        pool, _parse_pool = _parse_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
 
 
 class ToriConsumer:
 
-    def __init__(self, parser, max_pages):
+    def __init__(self, parser, max_pages, adaptive=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.parser = parser
         self.pages_max = max_pages
         self.pages_at_once = max(self.pages_max // 10, 5)
         self.page_num = 0
         self.p = mp.Pool(20)
+        self.fetcher = FetcherFactory.create()
+        self.detail_fetcher = FetcherFactory.create_detail()
+        self.breaker = CircuitBreaker(config.breaker_error_ratio, config.breaker_window, config.breaker_cooldown)
+        self.parser.executor = parse_pool()
+        self.adaptive = config.adaptive_paging if adaptive is None else adaptive
+        self.watermark = None
+        self.fanout = 1
+        self.all_new = False
+        self.stop_page = None
+        self.stop_lock = threading.Lock()
+        self.pages_fetched = 0
+        # event that ends scanning between pages, set on shutdown
+        self.stop = None
+
+    def set_watermark(self, date):
+        """
+        Date of the newest item already known. In adaptive mode scanning stops at the first page past it.
+        """
+        self.watermark = date
 
     def __iter__(self):
         self.page_num = 0
+        self.fanout = 1
+        self.all_new = False
+        self.stop_page = None
+        self.pages_fetched = 0
         return self
 
     def __next__(self) -> ToriItemList:
         """
         Loops over classifieds pages on tori.fi for given topic
         """
-        if self.page_num >= self.pages_max:
+        return functools.reduce(lambda x, y : x + y, self._next_batch(), self.parser.list_factory('fetch'))
+
+    def batches(self):
+        """
+        Same batches of pages as iterating the consumer, but each batch is an iterator over the items of its
+        pages, a page at a time as soon as it is parsed. A batch has to be read to the end before the next one.
+        """
+        iter(self)
+        while True:
+            try:
+                yield self._next_batch()
+            except StopIteration:
+                return
+
+    def _next_batch(self):
+        if self.page_num >= self.pages_max or self.stop_page is not None or self.breaker.is_open() or \
+                self._stopping():
             raise StopIteration
-        else:
-            end_page = min(self.pages_max, self.page_num + self.pages_at_once)
-            fetched = self.p.imap_unordered(self._fetch_page, range(self.page_num, end_page))
-            self.page_num = end_page
-            return functools.reduce(lambda x, y : x + y, fetched, self.parser.list_factory('fetch'))
+        pages = self.pages_at_once
+        if self.adaptive and self.watermark:
+            # start from a single page, double the fan-out only after a batch of nothing but new items and
+            # go back to one page at a time once known items show up
+            if self.page_num:
+                self.fanout = min(self.fanout * 2, self.pages_at_once) if self.all_new else 1
+            self.all_new = True
+            pages = self.fanout
+        end_page = min(self.pages_max, self.page_num + pages)
+        fetched = self.p.imap_unordered(self._fetch_page, range(self.page_num, end_page))
+        self.page_num = end_page
+        return fetched
+
+    def _past_watermark(self, items: ToriItemList):
+        # a few old pinned ads may show up on any page, so require most of the page to be older
+        older = sum(1 for item in items if item.date < self.watermark)
+        return older > len(items) // 2
+
+    def _cancelled(self, page_num):
+        return self.stop_page is not None and page_num > self.stop_page or self._stopping()
+
+    def _stopping(self):
+        return self.stop is not None and self.stop.is_set()
 
     def _add_details(self, item: ToriItem) -> ToriItem:
         try:
-            return self.parser.enrich(self._url_getter, item)
+            return self.parser.enrich(self._detail_getter, item)
         except:
             self.logger.error('failed to fetch details: {}'.format(item))
             self.logger.error('Exception:\n{}'.format(traceback.format_exc()))
@@ -180,24 +320,31 @@ class ToriConsumer:
         except KeyboardInterrupt as e:
             raise e
 
-    def _url_getter(self, url, user_msg=None):
+    def _detail_getter(self, url, user_msg=None):
+        return self._url_getter(url, user_msg, fetcher=self.detail_fetcher, kind='detail')
+
+    def _url_getter(self, url, user_msg=None, fetcher=None, kind='listing'):
         start = datetime.datetime.now()
         quoted = urllib.parse.quote(url, safe=':/&=?')
         try:
-            with urllib.request.urlopen(quoted) as response:
-                page_data = response.read()
-                duration = (datetime.datetime.now() - start).total_seconds()
-                user_msg = user_msg + ' -- ' if user_msg else ''
-                self.logger.debug(f'{user_msg}{len(page_data) / 1000:.1f} KB, took {duration:.2f} s -- {quoted}')
-                return page_data
+            page_data = (fetcher or self.fetcher).get(quoted)
+            duration = (datetime.datetime.now() - start).total_seconds()
+            FETCH_SECONDS.observe(duration, kind=kind)
+            FETCH_BYTES.inc(len(page_data), kind=kind)
+            user_msg = user_msg + ' -- ' if user_msg else ''
+            self.logger.debug(f'{user_msg}{len(page_data) / 1000:.1f} KB, took {duration:.2f} s -- {quoted}')
+            self.breaker.record(True)
+            return page_data
         except KeyboardInterrupt as e:
             raise e
         except:
+            FETCH_ERRORS.inc(kind=kind)
+            self.breaker.record(False)
             self.logger.error('failed to fetch: {}'.format(quoted))
             self.logger.error('Exception:\n{}'.format(traceback.format_exc()))
 
     def _page_reader(self, page_num):
-        url_base = 'https://www.tori.fi/'
+        url_base = config.base_url
         url_search_all = 'koko_suomi' + self.parser.topic
         url_search_string = ''
         page_pos = 'o=' + str(page_num)
@@ -205,7 +352,18 @@ class ToriConsumer:
         return self._url_getter(url_to_search)
 
     def _fetch_page(self, page_num) -> ToriItemList:
+        if self._cancelled(page_num) or self.breaker.is_open():
+            return self.parser.list_factory('fetch')
         html = self._page_reader(page_num)
+        self.pages_fetched += 1
         items = self.parser.parse(html)
+        if self.adaptive and self.watermark:
+            if not len(items) or any(item.date <= self.watermark for item in items):
+                self.all_new = False
+        if self.adaptive and self.watermark and len(items) and self._past_watermark(items):
+            with self.stop_lock:
+                if self.stop_page is None or page_num < self.stop_page:
+                    self.logger.debug('page {} is past the newest known item, stopping'.format(page_num))
+                    self.stop_page = page_num
         items.remove_buys()
         return items
@@ -1,35 +1,184 @@
+import datetime
+import functools
 import logging
-import MySQLdb
-import MySQLdb.cursors
 import traceback
 import glob
 import pathlib
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    # only needed with db_conn = mysql
+    MySQLdb = None
 
 import config
+import metrics
 
+DB_SECONDS = metrics.histogram('tori_db_query_seconds', 'Duration of ToriSQLDB calls', ['method'])
+DB_POOL_IDLE = metrics.gauge('tori_db_pool_idle_connections', 'Idle pooled MySQL connections',
+                             func=lambda: sum(pool.idle.qsize() for pool in DBConnection.pools.values()))
 
-class DBConnection:
-    def __init__(self, connect_with_name=True):
-        self.db = None
+
+# can't connect, server gone away, lost connection during query, and our own code for a pool without free connections
+MYSQL_CONNECTION_ERRORS = (2002, 2003, 2006, 2013)
+POOL_EXHAUSTED = -1
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of open MySQL connections. Connections idle for longer than ping_interval are pinged
+    before being handed out and replaced if the server has dropped them.
+    """
+    def __init__(self, size, connect_with_name=True, timeout=30, ping_interval=30):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = size
         self.connect_with_name = connect_with_name
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.connects = 0
+        self.reconnects = 0
 
-    def __enter__(self):
+    def _connect(self):
         if self.connect_with_name:
-            self.db = MySQLdb.connect(host=config.db_host, user=config.db_user, passwd=config.db_pass, db=config.db_name,
-                                      cursorclass=MySQLdb.cursors.DictCursor)
+            db = MySQLdb.connect(host=config.db_host, user=config.db_user, passwd=config.db_pass, db=config.db_name,
+                                 cursorclass=MySQLdb.cursors.DictCursor)
         else:
-            self.db = MySQLdb.connect(host=config.db_host, user=config.db_user, passwd=config.db_pass,
-                                      cursorclass=MySQLdb.cursors.DictCursor)
-        self.db.set_character_set('utf8')
-        return self.db.cursor()
+            db = MySQLdb.connect(host=config.db_host, user=config.db_user, passwd=config.db_pass,
+                                 cursorclass=MySQLdb.cursors.DictCursor)
+        db.set_character_set('utf8')
+        with self.lock:
+            self.connects += 1
+        return db
+
+    def _reserve(self):
+        with self.lock:
+            if self.open < self.size:
+                self.open += 1
+                return True
+            return False
+
+    def _release(self):
+        with self.lock:
+            self.open -= 1
+
+    def checkout(self):
+        start = time.monotonic()
+        try:
+            db, last_used = self.idle.get_nowait()
+        except queue.Empty:
+            if self._reserve():
+                try:
+                    db, last_used = self._connect(), time.monotonic()
+                except Exception:
+                    self._release()
+                    raise
+            else:
+                try:
+                    db, last_used = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise MySQLdb.OperationalError(POOL_EXHAUSTED,
+                                                   'no free connection in pool after {} s'.format(self.timeout))
+        waited = time.monotonic() - start
+        if time.monotonic() - last_used > self.ping_interval:
+            db = self._check(db)
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += waited
+        return db
+
+    def _check(self, db):
+        try:
+            db.ping()
+            return db
+        except MySQLdb.Error:
+            self.logger.warning('connection dropped by server, reconnecting')
+            try:
+                db.close()
+            except MySQLdb.Error:
+                pass
+        try:
+            db = self._connect()
+        except Exception:
+            self._release()
+            raise
+        with self.lock:
+            self.reconnects += 1
+        return db
+
+    def checkin(self, db):
+        self.idle.put((db, time.monotonic()))
+
+    def discard(self, db):
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+        self._release()
+
+    def stats(self):
+        with self.lock:
+            return {'size': self.size, 'open': self.open, 'idle': self.idle.qsize(), 'checkouts': self.checkouts,
+                    'wait_time': round(self.wait_time, 3), 'connects': self.connects, 'reconnects': self.reconnects}
+
+
+class DBConnection:
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, connect_with_name=True, tuples=False):
+        if MySQLdb is None:
+            raise RuntimeError('db_conn = mysql needs the mysqlclient package')
+        self.db = None
+        self.tuples = tuples
+        self.pool = DBConnection.get_pool(connect_with_name)
+
+    @staticmethod
+    def get_pool(connect_with_name=True) -> ConnectionPool:
+        with DBConnection.pools_lock:
+            if connect_with_name not in DBConnection.pools:
+                size = config.db_pool_size if connect_with_name else 1
+                DBConnection.pools[connect_with_name] = ConnectionPool(size, connect_with_name,
+                                                                       timeout=config.db_pool_timeout)
+            return DBConnection.pools[connect_with_name]
+
+    @staticmethod
+    def unavailable(error):
+        """
+        True for errors that mean the server can't be reached, as opposed to statements or rows it refuses.
+        """
+        if isinstance(error, MySQLdb.InterfaceError):
+            return True
+        code = error.args[0] if isinstance(error, MySQLdb.OperationalError) and error.args else None
+        return code in MYSQL_CONNECTION_ERRORS or code == POOL_EXHAUSTED
+
+    def __enter__(self):
+        self.db = self.pool.checkout()
+        return self.db.cursor(MySQLdb.cursors.Cursor) if self.tuples else self.db.cursor()
 
     def __exit__(self, type, value, traceback):
-        self.db.commit()
-        self.db.close()
+        try:
+            if type is None:
+                self.db.commit()
+            else:
+                self.db.rollback()
+        except MySQLdb.Error:
+            self.pool.discard(self.db)
+            raise
+        self.pool.checkin(self.db)
 
 
 class DummyDBConnection:
-    def __init__(self, connect_with_name=True):
+    def __init__(self, connect_with_name=True, tuples=False):
         pass
 
     def __enter__(self):
@@ -46,6 +195,81 @@ class DummyDBConnection:
         pass
 
 
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(' '))
+sqlite3.register_converter('datetime', lambda b: datetime.datetime.fromisoformat(b.decode()))
+
+
+@functools.lru_cache(maxsize=None)
+def _sqlite_sql(sql):
+    return sql.replace('%s', '?')
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    """
+    Runs the MySQLdb style %s queries of ToriSQLDB on a sqlite3 cursor. Each statement is translated once, the
+    translated strings are then reused from the statement cache of the connection.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self._last_executed = None
+
+    def execute(self, sql, vals=None):
+        self._last_executed = sql
+        self.cursor.execute(_sqlite_sql(sql), vals or ())
+
+    def executemany(self, sql, vals):
+        self._last_executed = sql
+        self.cursor.executemany(_sqlite_sql(sql), vals)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class SQLiteConnection:
+    """
+    One connection to config.sqlite_path per thread, in WAL mode so readers never wait for the writer. Everything
+    done inside one with block is a single transaction.
+    """
+    local = threading.local()
+
+    def __init__(self, connect_with_name=True, tuples=False):
+        self.tuples = tuples
+
+    @staticmethod
+    def unavailable(error):
+        return isinstance(error, sqlite3.OperationalError) and \
+            any(text in str(error) for text in ('database is locked', 'unable to open'))
+
+    @staticmethod
+    def connection():
+        db = getattr(SQLiteConnection.local, 'db', None)
+        if db is None:
+            pathlib.Path(config.sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(config.sqlite_path, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES,
+                                 cached_statements=256)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            SQLiteConnection.local.db = db
+        return db
+
+    def __enter__(self):
+        self.db = self.connection()
+        cursor = self.db.cursor()
+        if not self.tuples:
+            cursor.row_factory = _dict_row
+        return SQLiteCursor(cursor)
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.db.commit()
+        else:
+            self.db.rollback()
+
+
 class ToriSQLDB:
 
     def __init__(self, dbconn):
@@ -53,8 +277,8 @@ class ToriSQLDB:
         self.logger = logging.getLogger(self.__class__.__name__)
         self._create_if_needed()
 
-    def _execute(self, sql, vals=None, with_name=True, fetch=False):
-        with self.db(with_name) as cur:
+    def _execute(self, sql, vals=None, with_name=True, fetch=False, tuples=False):
+        with self.db(with_name, tuples) as cur:
             try:
                 cur.execute(sql, vals)
                 if fetch:
@@ -76,6 +300,57 @@ class ToriSQLDB:
                 self.logger.warning('table {} was not found, creating it'.format(table_name))
                 with open(file_name, mode='r') as f:
                     self._execute(f.read())
+        self._migrate()
+
+    @staticmethod
+    def _statements(script):
+        lines = [line for line in script.splitlines() if not line.lstrip().startswith('--')]
+        return [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+
+    def _migrate(self):
+        """
+        Applies dbscripts/migrations/NNN_*.sql in order, each one once. The table scripts stay as the
+        baseline schema, so new and existing databases end up in the same state. Raises when a migration
+        fails, the queries of this class need the migrated schema.
+        """
+        with self.db() as cur:
+            cur.execute('SELECT Version FROM SchemaMigration', None)
+            applied = {row['Version'] for row in cur.fetchall()}
+        for file_name in sorted(glob.glob(str(pathlib.Path('dbscripts', 'migrations', '*.sql')))):
+            version = pathlib.Path(file_name).stem
+            if version in applied:
+                continue
+            self.logger.warning('applying schema migration {}'.format(version))
+            with open(file_name, mode='r') as f:
+                statements = self._statements(f.read())
+            try:
+                with self.db() as cur:
+                    for stmt in statements:
+                        cur.execute(stmt, None)
+                    cur.execute('INSERT INTO SchemaMigration (Version) VALUES (%s)', (version,))
+            except Exception as e:
+                # the steps of a migration are skipped when already done, so it is simply retried on the next start
+                raise RuntimeError('schema migration {} failed, not starting with an outdated schema'.format(
+                    version)) from e
+
+    @staticmethod
+    def _upsert_sql(table, columns):
+        """
+        INSERT that updates the existing row of the same ToriId. A changed price is kept in PrevPrice, the
+        assignments run left to right so they have to come before Price itself is overwritten.
+        """
+        updates = ['PrevPrice = IF(Price <=> VALUES(Price), PrevPrice, Price)',
+                   'PriceChanged = IF(Price <=> VALUES(Price), PriceChanged, NOW())']
+        updates += ['{0} = VALUES({0})'.format(column) for column in columns if column != 'ToriId']
+        return 'INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(updates))
+
+    @staticmethod
+    def _change_sql(table):
+        # parameters: new price twice for the comparisons, new price, new date, toriid
+        return ('UPDATE {} SET PrevPrice = IF(Price <=> %s, PrevPrice, Price), '
+                'PriceChanged = IF(Price <=> %s, PriceChanged, NOW()), '
+                'Price = %s, Date = %s WHERE ToriId = %s'.format(table))
 
     def add_user(self, email):
         return self._execute("INSERT INTO User (Email) Values (%s)", (email,))
@@ -87,6 +362,14 @@ class ToriSQLDB:
         rows = self._execute("SELECT * FROM User WHERE UserId = %s", [user_id], fetch=True)
         return rows[0]['Email']
 
+    def get_emails(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        rows = self._execute("SELECT UserId, Email FROM User WHERE UserId IN ({})".format(
+            ', '.join(['%s'] * len(user_ids))), user_ids, fetch=True)
+        return {row['UserId']: row['Email'] for row in rows or []}
+
     def get_items(self, date=None, category=None):
         if date:
             start = date.strftime("%Y-%m-%d")
@@ -96,6 +379,22 @@ class ToriSQLDB:
             rows = self._execute("SELECT * FROM Item ORDER BY ItemId DESC LIMIT 100000", fetch=True)
         return list(rows)
 
+    def get_item_rows(self, table, columns, limit=100000):
+        """
+        Newest rows of Item or Car as plain tuples of the given columns, much cheaper to build than dicts.
+        """
+        rows = self._execute("SELECT {} FROM {} ORDER BY ItemId DESC LIMIT %s".format(', '.join(columns), table),
+                             (limit,), fetch=True, tuples=True)
+        return list(rows or [])
+
+    def get_item_keys(self, table, limit):
+        """
+        (ToriId, Price, Date) of the newest rows of Item or Car, newest first, read through the Date index.
+        """
+        rows = self._execute("SELECT ToriId, Price, Date FROM {} ORDER BY Date DESC LIMIT %s".format(table),
+                             (limit,), fetch=True, tuples=True)
+        return list(rows or [])
+
     def get_descriptions(self):
         rows = self._execute("SELECT Description FROM Item", fetch=True)
         return list(rows)
@@ -106,16 +405,46 @@ class ToriSQLDB:
                       (item.description, item.price, item.date, item.imageurl, item.toriurl,
                        item.toriid, item.category, item.location, user_id))
 
-    def store_items(self, items):
+    def store_item_alarms(self, alarms):
+        if not alarms:
+            return
         with self.db() as cur:
             try:
-                items_list = [(item.description, item.price, item.date, item.imageurl, item.toriurl, item.toriid,
-                               item.category, item.location) for item in items]
-                cur.executemany("INSERT INTO Item (Description, Price, Date, ImageURL, ToriURL, ToriId, Category, Location) \
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", items_list)
-            except (MySQLdb.IntegrityError, UnicodeEncodeError):
-                self.logger.warning('unable to add entries')
-                self.logger.warning(traceback.format_exc())
+                rows = [(item.description, item.price, item.date, item.imageurl, item.toriurl,
+                         item.toriid, item.category, item.location, user_id) for user_id, item in alarms]
+                cur.executemany("INSERT INTO ItemAlarm (Description, Price, Date, ImageURL, ToriURL, ToriId, Category, Location, UserId) \
+                                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+            except Exception:
+                self.logger.error(cur._last_executed)
+                self.logger.error(traceback.format_exc())
+
+    item_columns = ('Description', 'Price', 'Date', 'ImageURL', 'ToriURL', 'ToriId', 'Category', 'Location')
+    car_columns = item_columns + ('car_ac', 'car_cruise', 'car_engine_heater', 'car_hook', 'car_fuel_expense',
+                                  'car_tax', 'car_year', 'car_odo', 'car_fuel_type', 'car_gear', 'car_plate',
+                                  'car_type', 'car_description_extra', 'car_info')
+
+    # store_items, store_cars and store_changes raise on errors, the caller decides what to do with the rows
+
+    def store_items(self, items):
+        items_list = [(item.description, item.price, item.date, item.imageurl, item.toriurl, item.toriid,
+                       item.category, item.location) for item in items]
+        with self.db() as cur:
+            cur.executemany(self._upsert_sql('Item', self.item_columns), items_list)
+
+    def store_changes(self, table, items):
+        """
+        Updates price and date of items already stored in Item or Car in place and records every price change
+        as an ItemPrice event.
+        """
+        events = [(i.toriid, table, i.change, i.prev_price, i.price, i.date) for i in items if i.change != 'relist']
+        with self.db() as cur:
+            cur.executemany(self._change_sql(table), [(i.price, i.price, i.price, i.date, i.toriid) for i in items])
+            if events:
+                cur.executemany("INSERT INTO ItemPrice (ToriId, Source, ChangeType, PrevPrice, Price, Date) "
+                                "VALUES (%s, %s, %s, %s, %s, %s)", events)
+
+    def get_price_history(self, toriid):
+        return self._execute("SELECT * FROM ItemPrice WHERE ToriId = %s ORDER BY Recorded", (toriid,), fetch=True)
 
     def get_cars(self):
         rows = self._execute('SELECT * FROM Car ORDER BY ItemId DESC LIMIT 10000', fetch=True)
@@ -128,31 +457,69 @@ class ToriSQLDB:
                            i.car_engine_heater, i.car_hook, i.car_fuel_expense, i.car_tax, i.car_year,
                            i.car_odo, i.car_fuel_type, i.car_gear, i.car_plate, i.car_type,
                            i.car_description_extra, i.car_info) for i in items]
-            try:
-                cur.executemany("INSERT INTO Car ("
-                                "Description, Price, Date, ImageURL, ToriURL, "
-                                "ToriId, Category, Location, car_ac, car_cruise, "
-                                "car_engine_heater, car_hook, car_fuel_expense, car_tax, car_year, "
-                                "car_odo, car_fuel_type, car_gear, car_plate, car_type, "
-                                "car_description_extra, car_info) "
-                                "VALUES ("
-                                "%s, %s, %s, %s, %s, "
-                                "%s, %s, %s, %s, %s, "
-                                "%s, %s, %s, %s, %s, "
-                                "%s, %s, %s, %s, %s, "
-                                "%s, %s)", items_list)
-            except:
-                self.logger.error(cur._last_executed)
-                self.logger.warning('unable to add entries')
-                self.logger.warning(traceback.format_exc())
+            cur.executemany(self._upsert_sql('Car', self.car_columns), items_list)
+
+
+class SQLiteDB(ToriSQLDB):
+    """
+    ToriSQLDB on an embedded SQLite file, for single machine installs and the benchmarks. The schema is created
+    from dbscripts/sqlite/schema.sql, which is kept equal to the MySQL table scripts with all migrations applied.
+    """
+    def _create_if_needed(self):
+        with open(pathlib.Path('dbscripts', 'sqlite', 'schema.sql'), mode='r') as f:
+            statements = self._statements(f.read())
+        with self.db() as cur:
+            for stmt in statements:
+                cur.execute(stmt)
+
+    @staticmethod
+    def _upsert_sql(table, columns):
+        # unlike MySQL every assignment sees the old row, so the order does not matter here
+        updates = ['PrevPrice = CASE WHEN Price IS excluded.Price THEN PrevPrice ELSE Price END',
+                   "PriceChanged = CASE WHEN Price IS excluded.Price THEN PriceChanged "
+                   "ELSE datetime('now', 'localtime') END"]
+        updates += ['{0} = excluded.{0}'.format(column) for column in columns if column != 'ToriId']
+        return 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (ToriId) DO UPDATE SET {}'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(updates))
+
+    @staticmethod
+    def _change_sql(table):
+        return ("UPDATE {} SET PrevPrice = CASE WHEN Price IS %s THEN PrevPrice ELSE Price END, "
+                "PriceChanged = CASE WHEN Price IS %s THEN PriceChanged ELSE datetime('now', 'localtime') END, "
+                "Price = %s, Date = %s WHERE ToriId = %s".format(table))
+
+
+def _instrumented(cls):
+    # every public method observes its duration under its own name
+    for name, member in list(vars(cls).items()):
+        if not name.startswith('_') and callable(member) and not isinstance(member, (staticmethod, type)):
+            setattr(cls, name, DB_SECONDS.timed(method=name)(member))
+    return cls
+
+
+_instrumented(ToriSQLDB)
+
 
 class DBFactory:
+    instance = None
+    lock = threading.Lock()
 
     @staticmethod
     def create():
-        if 'dummy' in config.db_conn.lower():
-            return ToriSQLDB(DummyDBConnection)
-        return ToriSQLDB(DBConnection)
+        # the database object is stateless apart from the connection pool, so all users share one
+        with DBFactory.lock:
+            if DBFactory.instance is None:
+                if 'dummy' in config.db_conn.lower():
+                    DBFactory.instance = ToriSQLDB(DummyDBConnection)
+                elif 'sqlite' in config.db_conn.lower():
+                    DBFactory.instance = SQLiteDB(SQLiteConnection)
+                else:
+                    DBFactory.instance = ToriSQLDB(DBConnection)
+            return DBFactory.instance
+
+    @staticmethod
+    def pool_stats():
+        return {('named' if with_name else 'unnamed'): pool.stats() for with_name, pool in DBConnection.pools.items()}
 
 
 if __name__ == '__main__':
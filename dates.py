@@ -0,0 +1,57 @@
+import datetime
+import time
+
+MONTHS_FIN = {'tam': 1, 'hel': 2, 'maa': 3, 'huh': 4, 'tou': 5, 'kes': 6,
+              'hei': 7, 'elo': 8, 'syy': 9, 'lok': 10, 'mar': 11, 'jou': 12}
+
+
+class FinnishDateParser:
+    """
+    Converts listing dates ('tänään 12:34', 'eilen 08:15', '3 tou 08:15') to datetimes. The same raw strings
+    repeat on every page, so results are memoized until midnight when 'tänään' and 'eilen' change meaning.
+    """
+    max_cache = 100000
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # (valid until timestamp, today, yesterday, cache) replaced as a whole so threads see a consistent day
+        self.state = (0.0, None, None, {})
+
+    def _new_day(self):
+        today = datetime.date.fromtimestamp(self.clock())
+        midnight = datetime.datetime.combine(today + datetime.timedelta(1), datetime.time())
+        self.state = (midnight.timestamp(), today, today - datetime.timedelta(1), {})
+        return self.state
+
+    def __call__(self, raw):
+        state = self.state
+        if self.clock() >= state[0]:
+            state = self._new_day()
+        cache = state[3]
+        try:
+            return cache[raw]
+        except KeyError:
+            pass
+        d = self._parse(raw, state[1], state[2])
+        if len(cache) >= self.max_cache:
+            cache.clear()
+        cache[raw] = d
+        return d
+
+    @staticmethod
+    def _parse(raw, today, yesterday):
+        parts = raw.split()
+        if parts[0] == 'tänään':
+            day, clock = today, parts[1]
+        elif parts[0] == 'eilen':
+            day, clock = yesterday, parts[1]
+        else:
+            day_num, month, clock = int(parts[0]), MONTHS_FIN[parts[1]], parts[2]
+            # dates carry no year, one later than today must be from last year, e.g. December ads seen in January
+            year = today.year - 1 if (month, day_num) > (today.month, today.day) else today.year
+            day = datetime.date(year, month, day_num)
+        hour, minute = clock.split(':')
+        return datetime.datetime(day.year, day.month, day.day, int(hour), int(minute))
+
+
+parse_date = FinnishDateParser()
@@ -0,0 +1,5 @@
+CREATE TABLE `SchemaMigration` (
+  `Version` varchar(100) NOT NULL,
+  `AppliedAt` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`Version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8
\ No newline at end of file
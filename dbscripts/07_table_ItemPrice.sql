@@ -0,0 +1,12 @@
+CREATE TABLE `ItemPrice` (
+  `ItemPriceId` int(11) NOT NULL AUTO_INCREMENT,
+  `ToriId` int(11) NOT NULL,
+  `Source` varchar(20) NOT NULL,
+  `ChangeType` varchar(20) NOT NULL,
+  `PrevPrice` int(11) DEFAULT NULL,
+  `Price` int(11) DEFAULT NULL,
+  `Date` datetime DEFAULT NULL,
+  `Recorded` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`ItemPriceId`),
+  KEY `idx_itemprice_toriid` (`ToriId`, `Recorded`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8
\ No newline at end of file
@@ -0,0 +1,32 @@
+-- every step is skipped when it is already done, DDL commits implicitly so a failed run is simply run again
+
+-- index ToriId first, the dedupe below would otherwise join millions of rows without an index. Not needed once
+-- the unique key of the last step exists.
+SET @ddl = IF(EXISTS(SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()
+                     AND TABLE_NAME = 'Car' AND INDEX_NAME IN ('idx_car_toriid_dedupe', 'uq_car_toriid')),
+              'DO 0',
+              'ALTER TABLE Car ADD KEY `idx_car_toriid_dedupe` (`ToriId`)');
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+-- keep only the newest row of every ad before the unique key can be added, the grouped derived table is
+-- materialized once instead of being joined row by row
+DELETE t FROM Car t
+  JOIN (SELECT ToriId, MAX(ItemId) AS KeepId FROM Car GROUP BY ToriId HAVING COUNT(*) > 1) dup
+    ON t.ToriId = dup.ToriId AND t.ItemId < dup.KeepId;
+
+-- a single ALTER is applied completely or not at all, the unique key tells whether it was
+SET @ddl = IF(EXISTS(SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()
+                     AND TABLE_NAME = 'Car' AND INDEX_NAME = 'uq_car_toriid'),
+              'DO 0',
+              'ALTER TABLE Car
+                 ADD COLUMN `PrevPrice` int(11) DEFAULT NULL,
+                 ADD COLUMN `PriceChanged` datetime DEFAULT NULL,
+                 ADD UNIQUE KEY `uq_car_toriid` (`ToriId`),
+                 ADD KEY `idx_car_date` (`Date`),
+                 ADD KEY `idx_car_category` (`Category`),
+                 DROP KEY `idx_car_toriid_dedupe`');
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
@@ -0,0 +1,8 @@
+-- alarms with PriceDropOnly set fire only when a known ad gets cheaper, skipped when the column exists
+SET @ddl = IF(EXISTS(SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()
+                     AND TABLE_NAME = 'Alarm' AND COLUMN_NAME = 'PriceDropOnly'),
+              'DO 0',
+              'ALTER TABLE Alarm ADD COLUMN `PriceDropOnly` tinyint(1) NOT NULL DEFAULT 0');
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
@@ -0,0 +1,90 @@
+-- the MySQL schema of dbscripts/*_table_*.sql with all migrations applied, in the SQLite dialect
+CREATE TABLE IF NOT EXISTS User (
+  UserId INTEGER PRIMARY KEY AUTOINCREMENT,
+  Email varchar(100) DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Item (
+  ItemId INTEGER PRIMARY KEY AUTOINCREMENT,
+  Description varchar(200) DEFAULT NULL,
+  Price int DEFAULT NULL,
+  Date datetime DEFAULT NULL,
+  ImageURL varchar(145) DEFAULT NULL,
+  ToriURL varchar(145) DEFAULT NULL,
+  ToriId int DEFAULT NULL,
+  Category varchar(145) DEFAULT NULL,
+  Location varchar(45) DEFAULT NULL,
+  PrevPrice int DEFAULT NULL,
+  PriceChanged datetime DEFAULT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_item_toriid ON Item (ToriId);
+CREATE INDEX IF NOT EXISTS idx_item_date ON Item (Date);
+CREATE INDEX IF NOT EXISTS idx_item_category ON Item (Category);
+
+CREATE TABLE IF NOT EXISTS Alarm (
+  AlarmId INTEGER PRIMARY KEY AUTOINCREMENT,
+  SearchPattern varchar(100) DEFAULT NULL,
+  MaxPrice int DEFAULT NULL,
+  MinPrice int DEFAULT NULL,
+  UserId int DEFAULT NULL REFERENCES User (UserId),
+  Location varchar(45) DEFAULT NULL,
+  PriceDropOnly tinyint NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS fk_alarm_user_idx ON Alarm (UserId);
+
+CREATE TABLE IF NOT EXISTS ItemAlarm (
+  ItemAlarmId INTEGER PRIMARY KEY AUTOINCREMENT,
+  Description varchar(200) DEFAULT NULL,
+  Price int DEFAULT NULL,
+  Date datetime DEFAULT NULL,
+  ImageURL varchar(145) DEFAULT NULL,
+  ToriURL varchar(145) DEFAULT NULL,
+  ToriId int DEFAULT NULL,
+  Category varchar(145) DEFAULT NULL,
+  Location varchar(45) DEFAULT NULL,
+  UserId int DEFAULT NULL REFERENCES User (UserId)
+);
+CREATE INDEX IF NOT EXISTS fk_itemalarm_user_idx ON ItemAlarm (UserId);
+
+CREATE TABLE IF NOT EXISTS Car (
+  ItemId INTEGER PRIMARY KEY AUTOINCREMENT,
+  Description varchar(200) DEFAULT NULL,
+  Price int DEFAULT NULL,
+  Date datetime DEFAULT NULL,
+  ImageURL varchar(145) DEFAULT NULL,
+  ToriURL varchar(145) DEFAULT NULL,
+  ToriId int DEFAULT NULL,
+  Category varchar(145) DEFAULT NULL,
+  Location varchar(45) DEFAULT NULL,
+  car_ac int DEFAULT NULL,
+  car_cruise int DEFAULT NULL,
+  car_engine_heater int DEFAULT NULL,
+  car_hook int DEFAULT NULL,
+  car_fuel_expense int DEFAULT NULL,
+  car_tax int DEFAULT NULL,
+  car_year int DEFAULT NULL,
+  car_odo int DEFAULT NULL,
+  car_fuel_type varchar(45) DEFAULT NULL,
+  car_gear varchar(45) DEFAULT NULL,
+  car_plate varchar(45) DEFAULT NULL,
+  car_type varchar(45) DEFAULT NULL,
+  car_description_extra varchar(1000) DEFAULT NULL,
+  car_info varchar(10000) DEFAULT NULL,
+  PrevPrice int DEFAULT NULL,
+  PriceChanged datetime DEFAULT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_car_toriid ON Car (ToriId);
+CREATE INDEX IF NOT EXISTS idx_car_date ON Car (Date);
+CREATE INDEX IF NOT EXISTS idx_car_category ON Car (Category);
+
+CREATE TABLE IF NOT EXISTS ItemPrice (
+  ItemPriceId INTEGER PRIMARY KEY AUTOINCREMENT,
+  ToriId int NOT NULL,
+  Source varchar(20) NOT NULL,
+  ChangeType varchar(20) NOT NULL,
+  PrevPrice int DEFAULT NULL,
+  Price int DEFAULT NULL,
+  Date datetime DEFAULT NULL,
+  Recorded datetime DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_itemprice_toriid ON ItemPrice (ToriId, Recorded);
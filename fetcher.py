@@ -0,0 +1,488 @@
+import asyncio
+import collections
+import email.utils
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import config
+
+# status code, header mapping with case-insensitive get() and the decoded body
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class UrllibFetcher:
+    """
+    Blocking fetcher, opens a new connection for every request.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def request(self, url, headers=None) -> Response:
+        request = urllib.request.Request(url, headers=dict(headers or {}, **{'Accept-Encoding': 'gzip'}))
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            # urllib raises for everything but 2xx, including 304 Not Modified
+            response = e
+        with response:
+            data = response.read()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return Response(response.status, response.headers, data)
+
+    def get(self, url) -> bytes:
+        response = self.request(url)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, 'HTTP {}'.format(response.status),
+                                         response.headers, None)
+        return response.body
+
+    def close(self):
+        pass
+
+
+class AsyncFetcher:
+    """
+    Runs an aiohttp session on its own event loop thread. Connections are kept alive and reused per host and
+    at most concurrency requests are in flight at once, no matter how many threads call get().
+    """
+    def __init__(self, concurrency, timeout):
+        if aiohttp is None:
+            raise RuntimeError('fetcher = asyncio needs the aiohttp package')
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fetcher', daemon=True)
+        self.thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._create_session(), self.loop).result()
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def _request(self, url, headers):
+        async with self.session.get(url, headers=headers) as response:
+            return Response(response.status, response.headers, await response.read())
+
+    async def _get(self, url):
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    def request(self, url, headers=None) -> Response:
+        return asyncio.run_coroutine_threadsafe(self._request(url, headers), self.loop).result()
+
+    def get(self, url) -> bytes:
+        return asyncio.run_coroutine_threadsafe(self._get(url), self.loop).result()
+
+    def close(self):
+        # also reached through every wrapper of this fetcher, only the first call does anything
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class TokenBucket:
+    """
+    Request rate limit for one host. The rate grows additively while requests succeed quickly and is halved
+    (at most once a second) when the site throttles or fails, Retry-After pauses the bucket altogether.
+    """
+    def __init__(self, rate, min_rate, max_rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    burst = max(1.0, self.rate)
+                    self.tokens = min(burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def increase(self):
+        with self.lock:
+            # about one more request per second for every second at the current rate
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def decrease(self, factor=0.5, pause=0.0):
+        with self.lock:
+            now = self.clock()
+            if pause > 0:
+                self.paused_until = max(self.paused_until, now + pause)
+                self.tokens = 0.0
+                self.updated = self.paused_until
+            if now - self.last_decrease >= 1:
+                self.rate = max(self.min_rate, self.rate * factor)
+                self.last_decrease = now
+
+
+def _retry_after(headers):
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class FetchError(Exception):
+    pass
+
+
+class RateLimitedFetcher:
+    """
+    Wraps a fetcher with a TokenBucket per host and retries throttled (429), failed (5xx) and broken requests
+    with jittered exponential backoff, or after Retry-After when the site sends one. Responses slower than
+    latency_target slow the rate down a little, as the site is likely getting busy.
+    """
+    def __init__(self, fetcher, rate, min_rate, max_rate, retries=3, backoff=1.0, latency_target=2.0):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.fetcher = fetcher
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.failed = 0
+
+    def bucket(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.min_rate, self.max_rate)
+            return self.buckets[host]
+
+    def stats(self):
+        with self.lock:
+            rates = {host: round(bucket.rate, 2) for host, bucket in self.buckets.items()}
+        return {'rates': rates, 'retried': self.retried, 'failed': self.failed}
+
+    def request(self, url, headers=None) -> Response:
+        bucket = self.bucket(url)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self.fetcher.request(url, headers)
+            except Exception as e:
+                reason, pause = repr(e), 0.0
+                bucket.decrease()
+            else:
+                if response.status != 429 and response.status < 500:
+                    if time.monotonic() - start > self.latency_target:
+                        bucket.decrease(factor=0.9)
+                    else:
+                        bucket.increase()
+                    return response
+                reason, pause = 'HTTP {}'.format(response.status), _retry_after(response.headers)
+                bucket.decrease(pause=pause)
+            if attempt == self.retries:
+                break
+            self.retried += 1
+            delay = pause or self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            self.logger.info('{}, retrying in {:.1f} s -- {}'.format(reason, delay, url))
+            time.sleep(delay)
+        self.failed += 1
+        raise FetchError('{} after {} attempts -- {}'.format(reason, self.retries + 1, url))
+
+    def get(self, url) -> bytes:
+        response = self.request(url)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, 'HTTP {}'.format(response.status),
+                                         response.headers, None)
+        return response.body
+
+    def close(self):
+        self.fetcher.close()
+
+
+class CircuitBreaker:
+    """
+    Opens when more than error_ratio of the last window requests failed and stays open for cooldown seconds,
+    after which requests are let through again with a clean slate.
+    """
+    def __init__(self, error_ratio, window, cooldown, clock=time.monotonic):
+        self.error_ratio = error_ratio
+        self.cooldown = cooldown
+        self.clock = clock
+        self.results = collections.deque(maxlen=window)
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def record(self, ok):
+        with self.lock:
+            self.results.append(ok)
+            if self.opened is None and len(self.results) == self.results.maxlen:
+                failures = self.results.count(False)
+                if failures > self.error_ratio * len(self.results):
+                    self.opened = self.clock()
+                    self.results.clear()
+
+    def remaining(self):
+        """
+        Seconds until the breaker closes, 0 when closed.
+        """
+        with self.lock:
+            if self.opened is None:
+                return 0.0
+            left = self.opened + self.cooldown - self.clock()
+            if left <= 0:
+                self.opened = None
+                return 0.0
+            return left
+
+    def is_open(self):
+        return self.remaining() > 0
+
+
+class _Entry:
+
+    __slots__ = ('body', 'etag', 'last_modified', 'stored')
+
+    def __init__(self, body, etag, last_modified, stored):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class CachingFetcher:
+    """
+    Wraps a fetcher with an LRU response cache held in memory and optionally on disk, both bounded in bytes.
+    Entries younger than ttl seconds are served as is, older ones are revalidated with If-None-Match and
+    If-Modified-Since when the site sent an ETag or Last-Modified and fetched again otherwise.
+    """
+    def __init__(self, fetcher, memory_bytes, cache_dir=None, disk_bytes=0, ttl=3600):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.fetcher = fetcher
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.memory_used = 0
+        self.disk = collections.OrderedDict()
+        self.disk_used = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # least recently used first, access time is kept in the file modification time
+            for path in sorted(self.cache_dir.glob('*.cache'), key=lambda p: p.stat().st_mtime):
+                size = path.stat().st_size
+                self.disk[path.name] = size
+                self.disk_used += size
+
+    def stats(self):
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses,
+                'memory_entries': len(self.memory), 'memory_bytes': self.memory_used,
+                'disk_entries': len(self.disk), 'disk_bytes': self.disk_used}
+
+    def get(self, url) -> bytes:
+        entry = self._lookup(url)
+        if entry is not None and time.time() - entry.stored < self.ttl:
+            self.hits += 1
+            return entry.body
+        response = self.fetcher.request(url, entry.validators() if entry is not None else None)
+        if response.status == 304 and entry is not None:
+            self.revalidated += 1
+            entry.stored = time.time()
+            self._store(url, entry)
+            return entry.body
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, 'HTTP {}'.format(response.status),
+                                         response.headers, None)
+        self.misses += 1
+        self._store(url, _Entry(response.body, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                                time.time()))
+        return response.body
+
+    def request(self, url, headers=None) -> Response:
+        return self.fetcher.request(url, headers)
+
+    def close(self):
+        self.fetcher.close()
+
+    def _lookup(self, url):
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is not None:
+                self.memory.move_to_end(url)
+                return entry
+        entry = self._read(url)
+        if entry is not None:
+            with self.lock:
+                self._remember(url, entry)
+        return entry
+
+    def _store(self, url, entry):
+        with self.lock:
+            self._remember(url, entry)
+        self._write(url, entry)
+
+    def _remember(self, url, entry):
+        old = self.memory.pop(url, None)
+        if old is not None:
+            self.memory_used -= len(old.body)
+        if len(entry.body) > self.memory_bytes:
+            return
+        self.memory[url] = entry
+        self.memory_used += len(entry.body)
+        while self.memory_used > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted.body)
+
+    @staticmethod
+    def _file_name(url):
+        return hashlib.sha1(url.encode()).hexdigest() + '.cache'
+
+    def _read(self, url):
+        if not self.cache_dir:
+            return None
+        name = self._file_name(url)
+        path = self.cache_dir / name
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        with self.lock:
+            if name in self.disk:
+                self.disk.move_to_end(name)
+        return _Entry(body, meta.get('etag'), meta.get('last_modified'), meta.get('stored', 0))
+
+    def _write(self, url, entry):
+        if not self.cache_dir or len(entry.body) > self.disk_bytes:
+            return
+        name = self._file_name(url)
+        path = self.cache_dir / name
+        meta = json.dumps({'url': url, 'etag': entry.etag, 'last_modified': entry.last_modified,
+                           'stored': entry.stored}).encode()
+        tmp = path.with_name('{}.{}.tmp'.format(name, threading.get_ident()))
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(meta + b'\n')
+                f.write(entry.body)
+            os.replace(tmp, path)
+        except OSError:
+            self.logger.exception('unable to write {}'.format(path))
+            return
+        size = len(meta) + 1 + len(entry.body)
+        evict = []
+        with self.lock:
+            self.disk_used += size - self.disk.pop(name, 0)
+            self.disk[name] = size
+            while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+                evicted, evicted_size = self.disk.popitem(last=False)
+                self.disk_used -= evicted_size
+                evict.append(evicted)
+        for evicted in evict:
+            try:
+                (self.cache_dir / evicted).unlink()
+            except OSError:
+                pass
+
+
+class FetcherFactory:
+    instance = None
+    detail_instance = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def create():
+        # one fetcher is shared by all consumers so that connections to the site are pooled together
+        with FetcherFactory.lock:
+            if FetcherFactory.instance is None:
+                if config.fetcher == 'asyncio':
+                    fetcher = AsyncFetcher(config.fetch_concurrency, config.fetch_timeout)
+                else:
+                    fetcher = UrllibFetcher(config.fetch_timeout)
+                if config.rate_limit > 0:
+                    fetcher = RateLimitedFetcher(fetcher, config.rate_limit, config.rate_limit_min,
+                                                 config.rate_limit_max, config.fetch_retries,
+                                                 config.fetch_backoff, config.latency_target)
+                FetcherFactory.instance = fetcher
+            return FetcherFactory.instance
+
+    @staticmethod
+    def create_detail():
+        # detail pages rarely change once published, they go through the response cache when it is enabled
+        fetcher = FetcherFactory.create()
+        with FetcherFactory.lock:
+            if FetcherFactory.detail_instance is None:
+                if config.detail_cache:
+                    FetcherFactory.detail_instance = CachingFetcher(
+                        fetcher, config.detail_cache_memory_mb * 1024 * 1024, config.detail_cache_dir,
+                        config.detail_cache_disk_mb * 1024 * 1024, config.detail_cache_ttl)
+                else:
+                    FetcherFactory.detail_instance = fetcher
+            return FetcherFactory.detail_instance
+
+    @staticmethod
+    def close():
+        """
+        Closes the shared fetchers, the next create() starts new ones.
+        """
+        with FetcherFactory.lock:
+            for fetcher in (FetcherFactory.detail_instance, FetcherFactory.instance):
+                if fetcher is not None:
+                    fetcher.close()
+            FetcherFactory.instance = None
+            FetcherFactory.detail_instance = None
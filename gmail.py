@@ -1,40 +1,180 @@
 import os
+import time
+import queue
+import atexit
+import random
 import logging
 import smtplib
+import threading
 import traceback
+from collections import OrderedDict, namedtuple
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 
 import config
+import metrics
 
-main_logger = logging.getLogger('email')
+EMAIL_SECONDS = metrics.histogram('tori_email_send_seconds', 'Duration of delivering one mail including retries')
+EMAILS = metrics.counter('tori_emails_total', 'Delivered and failed mails', ['result'])
+EMAIL_QUEUE = metrics.gauge('tori_email_queue_depth', 'Alarms waiting to be mailed',
+                            func=lambda: _dispatcher.queue.qsize() if _dispatcher else 0)
 
+Mail = namedtuple('Mail', ['to', 'subject', 'body', 'filename'])
 
-def send(to, subject, body, filename):
-    if hasattr(config, 'gmail_user') and hasattr(config, 'gmail_pass'):
 
+class MailDispatcher:
+    """
+    Sends queued mails from a background thread over one reused SMTP session. Mails to the same recipient
+    queued within digest_window seconds of each other are combined into one digest mail.
+    """
+    def __init__(self, host, port, starttls, user, password, digest_window=10, retries=5, backoff=2):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.digest_window = digest_window
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.smtp = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, to, subject, body, filename=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='mail', daemon=True)
+                self.thread.start()
+        self.queue.put(Mail(to, subject, body, filename))
+
+    def stop(self, timeout=60):
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            mail = self.queue.get()
+            if mail is None:
+                break
+            batch = [mail]
+            deadline = time.monotonic() + self.digest_window
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    mail = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if mail is None:
+                    stopping = True
+                    break
+                batch.append(mail)
+
+            by_recipient = OrderedDict()
+            for mail in batch:
+                by_recipient.setdefault(mail.to, []).append(mail)
+            for to, mails in by_recipient.items():
+                try:
+                    self._deliver(self._compose(to, mails))
+                except Exception:
+                    self.logger.error('failed to send mail to %s' % to)
+                    self.logger.error(traceback.format_exc())
+        self._close()
+
+    def _compose(self, to, mails):
         msg = MIMEMultipart()
-        msg['Subject'] = subject
-        msg['From'] = config.gmail_user
+        if len(mails) == 1:
+            msg['Subject'] = mails[0].subject
+            body = mails[0].body
+        else:
+            msg['Subject'] = '{} (+{} more)'.format(mails[0].subject, len(mails) - 1)
+            body = '\n\n'.join('{}\n{}'.format(mail.subject, mail.body) for mail in mails)
+        msg['From'] = self.user
         msg['To'] = to
+        msg.attach(MIMEText(body))
+
+        for mail in mails:
+            if mail.filename:
+                with open(mail.filename, 'rb') as img_f:
+                    msg.attach(MIMEImage(img_f.read(), name=os.path.basename('img.jpg')))
+        return msg
+
+    def _session(self):
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close()
+        # Allow access for less secure apps in your Google account, otherwise exception is thrown
+        smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.password:
+            smtp.login(self.user, self.password)
+        self.smtp = smtp
+        return smtp
+
+    def _close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
 
-        text = MIMEText(body)
-        msg.attach(text)
-
-        if filename:
-            with open(filename, 'rb') as img_f:
-                image = MIMEImage(img_f.read(), name=os.path.basename('img.jpg'))
-                msg.attach(image)
-
-        try:
-            # Allow access for less secure apps in your Google account, otherwise exception is thrown
-            s = smtplib.SMTP('smtp.gmail.com', 587)
-            s.ehlo()
-            s.starttls()
-            s.login(config.gmail_user, config.gmail_pass)
-            s.sendmail(msg['From'], msg['To'], msg.as_string())
-            s.quit()
-        except:
-            main_logger.error('failed to send mail to %s' % to)
-            traceback.print_exc()
+    def _deliver(self, msg):
+        with EMAIL_SECONDS.time():
+            sent = self._deliver_with_retries(msg)
+        EMAILS.inc(result='sent' if sent else 'failed')
+        return sent
+
+    def _deliver_with_retries(self, msg):
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self._session().sendmail(msg['From'], msg['To'], msg.as_string())
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                error = traceback.format_exc()
+                self._close()
+                permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or \
+                    (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500)
+                if permanent or attempt == self.retries:
+                    break
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                self.logger.warning('sending mail to {} failed ({}), retrying in {:.1f} s'.format(msg['To'], e, delay))
+                time.sleep(delay)
+        self.logger.error('failed to send mail to %s' % msg['To'])
+        self.logger.error(error)
+        return False
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatcher() -> MailDispatcher:
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = MailDispatcher(config.smtp_host, config.smtp_port, config.smtp_starttls,
+                                         config.gmail_user, config.gmail_pass,
+                                         digest_window=config.email_digest_window, retries=config.email_retries)
+            atexit.register(_dispatcher.stop)
+        return _dispatcher
+
+
+def send(to, subject, body, filename):
+    if hasattr(config, 'gmail_user') and hasattr(config, 'gmail_pass'):
+        dispatcher().send(to, subject, body, filename)
@@ -1,18 +1,81 @@
-import datetime, logging, re, inspect, hashlib
+import datetime, logging, sys, heapq, itertools
+import alarms
+from dates import parse_date
 import gmail
+import metrics
+import profiling
+import writer
+
+ALARM_MATCH_SECONDS = metrics.histogram('tori_alarm_match_seconds', 'Duration of matching a batch of items to alarms')
+ALARMS_SENT = metrics.counter('tori_alarms_total', 'Alarms matched, by whether the user has an email', ['result'])
 
 
 class ToriItem:
 
+    __slots__ = ('toriid', 'description', 'price', 'date', 'imageurl', 'toriurl', 'location', 'buy_or_sell',
+                 'category', 'change', 'prev_price')
+    # order of the columns read by from_row(), column names match the Item table
+    row_fields = ('toriid', 'description', 'price', 'date', 'imageurl', 'toriurl', 'category', 'location')
+    # few distinct values repeated in thousands of items
+    interned = ('location', 'buy_or_sell', 'category')
+
     def __init__(self, **kwargs):
+        for field in self.fields:
+            setattr(self, field, None)
         for k, v in kwargs.items():
-            self.__setattr__(k.translate('-').lower(), v)
+            k = k.lower()
+            if k not in self.field_set:
+                raise TypeError("{}() got an unexpected keyword argument '{}'".format(self.__class__.__name__, k))
+            setattr(self, k, v)
+        for field in self.interned:
+            value = getattr(self, field)
+            if value.__class__ is str:
+                setattr(self, field, sys.intern(value))
         if not isinstance(self.date, datetime.datetime):
             self.date = ToriItem._convert_date(self.date)
-        self.hash = hash((self.toriid, self.price))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._collect_fields()
+
+    @classmethod
+    def _collect_fields(cls):
+        cls.fields = tuple(field for klass in reversed(cls.__mro__) for field in getattr(klass, '__slots__', ()))
+        cls.field_set = frozenset(cls.fields)
+        cls.fields_not_in_row = tuple(field for field in cls.fields if field not in cls.row_fields)
+        cls.interned_in_row = tuple(field for field in cls.interned if field in cls.row_fields)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Creates an item from a database row tuple ordered as row_fields, skipping keyword argument handling.
+        """
+        item = cls.__new__(cls)
+        for field, value in zip(cls.row_fields, row):
+            setattr(item, field, value)
+        for field in cls.fields_not_in_row:
+            setattr(item, field, None)
+        for field in cls.interned_in_row:
+            value = getattr(item, field)
+            if value.__class__ is str:
+                setattr(item, field, sys.intern(value))
+        return item
+
+    @classmethod
+    def from_key(cls, toriid, price, date):
+        """
+        Creates an item with only the fields needed to recognize it in a later listing.
+        """
+        item = cls.__new__(cls)
+        for field in cls.fields:
+            setattr(item, field, None)
+        item.toriid = toriid
+        item.price = price
+        item.date = date
+        return item
 
     def __hash__(self):
-        return self.hash
+        return hash((self.toriid, self.price))
 
     def __str__(self):
         return '{0} - {1} {2: >30} {3: >10} {4: <45} {5}'.format(
@@ -23,31 +86,36 @@ class ToriItem:
             self.__setattr__(k, v)
 
     @staticmethod
+    @profiling.timed
     def _convert_date(d):
         # modify strings representing dates to python datetimes
-        months_fin = {1: 'tam', 2: 'hel', 3: 'maa', 4: 'huh', 5: 'tou', 6: 'kes',
-                      7: 'hei', 8: 'elo', 9: 'syy', 10: 'lok', 11: 'mar', 12: 'jou'}
-        months_fin2en = {'tam': 'Jan', 'hel': 'Feb', 'maa': 'Mar', 'huh': 'Apr', 'tou': 'May', 'kes': 'Jun',
-                         'hei': 'Jul', 'elo': 'Aug', 'syy': 'Sep', 'lok': 'Oct', 'mar': 'Nov', 'jou': 'Dec'}
-        today = datetime.date.today()
-        yesterday = datetime.date.today() - datetime.timedelta(1)
-
-        if 'tänään' in d:
-            d = '{} {} {}'.format(today.day, months_fin[today.month], d.split()[1])
-        if 'eilen' in d:
-            d = '{} {} {}'.format(yesterday.day, months_fin[yesterday.month], d.split()[1])
-        # all dates are now in format 'DD Month HH:MM'
-        date_split = d.split()
-        d = '{} {} {}'.format(date_split[0], months_fin2en[date_split[1]], date_split[2])
-        d = datetime.datetime.strptime(d, '%d %b %H:%M').replace(year=today.year)
-        return d
+        return parse_date(d)
+
+
+ToriItem._collect_fields()
+
+
+class CarItem(ToriItem):
+
+    __slots__ = ('car_type', 'car_year', 'car_tax', 'car_odo', 'car_fuel_expense', 'car_gear', 'car_fuel_type',
+                 'car_plate', 'car_cruise', 'car_hook', 'car_ac', 'car_engine_heater', 'car_description_extra',
+                 'car_info')
+    row_fields = ToriItem.row_fields + ('car_ac', 'car_cruise', 'car_engine_heater', 'car_hook', 'car_fuel_expense',
+                                        'car_tax', 'car_year', 'car_odo', 'car_fuel_type', 'car_gear', 'car_plate',
+                                        'car_type', 'car_description_extra', 'car_info')
+    interned = ToriItem.interned + ('car_type', 'car_gear', 'car_fuel_type')
 
 
 class ToriItemList:
 
+    item_class = ToriItem
+    table = 'Item'
+    store_method = 'store_items'
+
     def __init__(self, name, db=None, populate=False):
         self.name = name
         self.logger = logging.getLogger(name + '_list')
+        self.evicted = 0
         self.items = []
         self.db = db
         if populate:
@@ -59,48 +127,116 @@ class ToriItemList:
         l.items = other.items.copy()
         return l
 
+    @property
+    def items(self):
+        if self._list is None:
+            self._list = list(self._by_id.values())
+        return self._list
+
+    @items.setter
+    def items(self, items):
+        # toriid -> item in insertion order is the storage, a list is only built when items is read. A re-added
+        # toriid replaces the earlier item and moves to the end.
+        self._by_id = {}
+        self._list = None
+        self._newest = None
+        self._heap = None
+        for item in items:
+            self._index(item)
+
+    def _index(self, item: ToriItem):
+        self._by_id.pop(item.toriid, None)
+        self._by_id[item.toriid] = item
+        self._list = None
+        if item.date is not None and (self._newest is None or item.date > self._newest):
+            self._newest = item.date
+        if self._heap is not None:
+            heapq.heappush(self._heap, (self._date_key(item), next(self._seq), item))
+
+    @staticmethod
+    def _date_key(item):
+        return item.date if item.date is not None else datetime.datetime.min
+
+    def _retention_heap(self):
+        """
+        Min-heap of (date, sequence, item) used for eviction, built on first use and kept up to date from then
+        on. Entries of replaced items stay until they reach the top and are skipped there.
+        """
+        if self._heap is None or len(self._heap) > 2 * len(self._by_id) + 1000:
+            self._seq = itertools.count()
+            self._heap = [(self._date_key(item), next(self._seq), item) for item in self._by_id.values()]
+            heapq.heapify(self._heap)
+        heap = self._heap
+        while heap and self._by_id.get(heap[0][2].toriid) is not heap[0][2]:
+            heapq.heappop(heap)
+        return heap
+
     def __add__(self, other):
-        self.items += other.items
+        for item in other.items:
+            self._index(item)
         return self
 
     def __str__(self):
         return '\n'.join([str(item) for item in self.items])
 
     def __len__(self):
-        return len(self.items)
+        return len(self._by_id)
 
     def __getitem__(self, key) -> ToriItem:
-        if len(self.items) == 0:
+        if len(self) == 0:
             return None
         return self.items[key]
 
     def __iter__(self):
-        self.item_num = 0
-        return self
-
-    def __next__(self) -> ToriItem:
-        if self.item_num >= len(self.items):
-            raise StopIteration
-        else:
-            item = self.items[self.item_num]
-            self.item_num += 1
-            return item
+        return iter(self.items)
 
     def replace_items(self, items):
         self.items = [i for i in items if isinstance(i, ToriItem)]
 
+    def newest_date(self):
+        return self._newest
+
     def findById(self, id) -> ToriItem:
-        for i in self.items:
-            if i.toriid == id:
-                return i
+        return self._by_id.get(id)
 
-    def add(self, item: ToriItem):
-        self.items.append(item)
+    def oldest_date(self):
+        heap = self._retention_heap()
+        return heap[0][0] if heap else None
 
-    def diff_to(self, other):
-        my_hashes = [hash(item) for item in self.items]
+    def add(self, item: ToriItem):
+        self._index(item)
+
+    @profiling.timed
+    def diff_to(self, other, keep=None, max_age=None, now=None):
+        """
+        Items of other that are unknown to this list or whose price or date has changed. Each one is marked with
+        its change, 'new', 'price_drop', 'price_change' or 'relist' (same price, newer date), and prev_price
+        holds the last known price of a changed item. With the limits of truncate_oldest, unknown items it would
+        evict right away, such as promoted old ads, are left out, otherwise they would be new on every poll.
+        """
+        by_id = self._by_id
+        cutoff = (now or datetime.datetime.now()) - max_age if max_age else None
+        oldest = self.oldest_date() if keep is not None and len(by_id) >= keep else None
+        changed = []
+        for item in other.items:
+            known = by_id.get(item.toriid)
+            if known is None:
+                date = self._date_key(item)
+                if (cutoff is not None and date < cutoff) or (oldest is not None and date < oldest):
+                    continue
+                item.change = 'new'
+            elif item.price != known.price:
+                dropped = isinstance(item.price, int) and isinstance(known.price, int) and item.price < known.price
+                item.change = 'price_drop' if dropped else 'price_change'
+                item.prev_price = known.price
+            elif known.date is not None and item.date > known.date:
+                item.change = 'relist'
+                item.prev_price = known.price
+            else:
+                continue
+            changed.append(item)
         rv = self.__class__('diff')
-        rv.items = [item for item in other.items if hash(item) not in my_hashes]
+        rv.items = changed
         return rv
 
     def reset(self):
@@ -112,98 +248,101 @@ class ToriItemList:
     def sort_by_date(self):
         return sorted(self.items, reverse=False, key=lambda k: k.date)
 
-    def truncate_oldest(self, n):
-        self.sort_by_date()
-        if len(self.items) > n:
-            self.logger.info('removing {} oldest items'.format(len(self.items) - n))
-            self.items = self.items[-n:]
+    def truncate_oldest(self, n, max_age=None, now=None):
+        """
+        Evicts the items with the oldest dates until at most n are left and, with max_age, every item older than
+        that. Each eviction is a heap pop, the cost does not grow with the number of items kept. Returns the
+        number of evicted items.
+        """
+        heap = self._retention_heap()
+        cutoff = (now or datetime.datetime.now()) - max_age if max_age else None
+        evicted = 0
+        while heap and (len(self._by_id) > n or (cutoff is not None and heap[0][0] < cutoff)):
+            item = heapq.heappop(heap)[2]
+            if self._by_id.get(item.toriid) is item:
+                del self._by_id[item.toriid]
+                evicted += 1
+            heap = self._retention_heap()
+        if evicted:
+            self._list = None
+            if not self._by_id:
+                self._newest = None
+            self.evicted += evicted
+            self.logger.info('removed {} oldest items'.format(evicted))
+        return evicted
 
     def populate(self):
         if self.db:
-            fetched = self.db.get_items()
-            self.items = [ToriItem(**x) for x in fetched]
+            fetched = self.db.get_item_rows(self.table, self.item_class.row_fields)
+            self.items = [self.item_class.from_row(row) for row in fetched]
 
-    def persist(self):
-        if self.db and len(self.items):
-            self.db.store_items(self.items)
+    def populate_keys(self, limit):
+        """
+        Loads toriid, price and date of the newest limit items, oldest first, which is all diffing needs.
+        """
+        if self.db:
+            rows = self.db.get_item_keys(self.table, limit)
+            self.items = [self.item_class.from_key(*row) for row in reversed(rows)]
 
+    def persist(self):
+        """
+        Inserts new items and only updates price and date of the changed ones, recording their price history.
+        With write_behind the rows are only queued for the background writer.
+        """
+        if not self.db or not len(self.items):
+            return
+        new = [item for item in self.items if item.change in (None, 'new')]
+        changed = [item for item in self.items if item.change not in (None, 'new')]
+        behind = writer.get(self.db)
+        if new:
+            if behind:
+                behind.submit(self.store_method, new)
+            else:
+                getattr(self.db, self.store_method)(new)
+        if changed:
+            if behind:
+                behind.submit('store_changes', changed, self.table)
+            else:
+                self.db.store_changes(self.table, changed)
+
+    @profiling.timed
     def check_for_alarms(self):
         if not self.db or not len(self.items):
             return
-        alarms = self.db.get_alarms()
-        if not alarms:
+        matcher = alarms.get_matcher(self.db)
+        if not len(matcher):
+            return
+
+        with ALARM_MATCH_SECONDS.time():
+            matches = matcher.match(self.items)
+        if not matches:
             return
-        alarms_sent = {}
-
-        for alarm in alarms:
-            if 'SearchPattern' in alarm and alarm['SearchPattern']:
-                alarm['RegexSearchPattern'] = re.compile(alarm['SearchPattern'], re.IGNORECASE)
-            if 'Location' in alarm and alarm['Location']:
-                alarm['RegexLocation'] = re.compile(alarm['Location'], re.IGNORECASE)
-
-        self.logger.debug('alarms: {}'.format(alarms))
-        for item in self.items:
-            for alarm in alarms:
-                description_ok = False if 'SearchPattern' in alarm and alarm['SearchPattern'] else True
-                location_ok = False if 'Location' in alarm and alarm['Location'] else True
-                maxprice_ok = False if 'MaxPrice' in alarm and alarm['MaxPrice'] else True
-                minprice_ok = False if 'MinPrice' in alarm and alarm['MinPrice'] else True
-
-                if 'SearchPattern' in alarm and alarm['SearchPattern']:
-                    if alarm['RegexSearchPattern'].match(item.description):
-                        description_ok = True
-
-                if description_ok and 'Location' in alarm and alarm['Location']:
-                    if alarm['RegexLocation'].match(item.location):
-                        location_ok = True
-
-                if description_ok and location_ok and isinstance(item.price, int):
-                    if 'MaxPrice' in alarm and alarm['MaxPrice'] and item.price < alarm['MaxPrice']:
-                        maxprice_ok = True
-                    if 'MinPrice' in alarm and alarm['MinPrice'] and item.price > alarm['MinPrice']:
-                        minprice_ok = True
-
-                self.logger.debug('description {0: <20} {1: <20} item value {2: <20}'.format(
-                    alarm['SearchPattern'] if alarm['SearchPattern'] else 'None',
-                    'passed' if description_ok else 'failed',
-                    item.description))
-                self.logger.debug('location    {0: <20} {1: <20} item value {2: <20}'.format(
-                    alarm['Location'] if alarm['Location'] else 'None',
-                    'passed' if location_ok else 'failed',
-                    item.location))
-                self.logger.debug('maxprice    {0: <20} {1: <20} item value {2: <20}'.format(
-                    alarm['MaxPrice'] if alarm['MaxPrice'] else 'None',
-                    'passed' if maxprice_ok else 'failed',
-                    item.price if item.price else 'None'))
-                self.logger.debug('minprice    {0: <20} {1: <20} item value {2: <20}'.format(
-                    alarm['MinPrice'] if alarm['MinPrice'] else 'None',
-                    'passed' if maxprice_ok else 'failed',
-                    item.price if item.price else 'None'))
-
-                if all([description_ok, location_ok, maxprice_ok, minprice_ok]):
-                    if item.toriid not in alarms_sent or (
-                            item.toriid in alarms_sent and alarm['UserId'] not in alarms_sent[item.toriid]):
-                        email = self.db.get_email(alarm['UserId'])
-                        if email:
-                            self.logger.info(
-                                'alarm {} for "{}, {} eur"'.format(email, item.description, item.price))
-                            gmail.send(email, 'Tori.fi: {}, {}'.format(item.description, item.price),
-                                       item.toriurl, None)
-                            self.db.store_item_alarm(alarm['UserId'], item)
-                        else:
-                            self.logger.info('alarm found "{}, {} eur"'.format(item.description, item.price))
-                        alarms_sent.setdefault(item.toriid, []).append(alarm['UserId'])
-                    else:
-                        self.logger.info('alarm already sent to UserId {} for "{}, {} eur"'.format(alarm['UserId'],
-                                                                                                   item.description,
-                                                                                                   item.price))
+        emails = self.db.get_emails({alarm['UserId'] for _, alarm in matches})
+
+        sent = []
+        for item, alarm in matches:
+            email = emails.get(alarm['UserId'])
+            if email:
+                self.logger.info(
+                    'alarm {} for "{}, {} eur"'.format(email, item.description, item.price))
+                subject = 'Tori.fi: {}, {}'.format(item.description, item.price)
+                if item.change == 'price_drop':
+                    subject += ' (was {})'.format(item.prev_price)
+                gmail.send(email, subject, item.toriurl, None)
+                sent.append((alarm['UserId'], item))
+                ALARMS_SENT.inc(result='sent')
+            else:
+                ALARMS_SENT.inc(result='no_email')
+                self.logger.info('alarm found "{}, {} eur"'.format(item.description, item.price))
+        self.db.store_item_alarms(sent)
 
 class CarItemList(ToriItemList):
 
-    def populate(self):
-        if self.db:
-            self.items = [ToriItem(**x) for x in self.db.get_cars()]
+    item_class = CarItem
+    table = 'Car'
+    store_method = 'store_cars'
 
-    def persist(self):
+    def populate(self):
         if self.db:
-            self.db.store_cars(self.items)
\ No newline at end of file
+            fetched = self.db.get_item_rows(self.table, self.item_class.row_fields, limit=10000)
+            self.items = [self.item_class.from_row(row) for row in fetched]
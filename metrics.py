@@ -0,0 +1,280 @@
+import bisect
+import functools
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger('metrics')
+
+# seconds, from a cached dictionary lookup to a slow page fetch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    def _samples(self):
+        for key, child in sorted(self.children.items()):
+            yield from child.samples(self.name, dict(zip(self.label_names, key)))
+
+
+class _Value:
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _child = _Value
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    Value set by the code, or read from func when the metrics are collected.
+    """
+    kind = 'gauge'
+    _child = _Value
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+    def _samples(self):
+        if self.func is not None:
+            try:
+                yield self.name, {}, self.func()
+            except Exception:
+                logger.exception('unable to read {}'.format(self.name))
+            return
+        yield from super()._samples()
+
+
+class _Buckets:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            yield name + '_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        return _Timer(self.labels(**labels))
+
+    def timed(self, **labels):
+        """
+        Decorator observing the duration of every call.
+        """
+        def decorate(func):
+            child = self.labels(**labels)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+
+class _Timer:
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        self.child.observe(self.elapsed)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._register(Gauge, name, help, labels, func)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample, labels, value in metric._samples():
+                if labels:
+                    text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for k, v in labels.items())
+                    sample = '{}{{{}}}'.format(sample, text)
+                lines.append('{} {}'.format(sample, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        One line per counter, gauge and histogram series, histograms as count and mean.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            if isinstance(metric, Histogram):
+                for key, child in sorted(metric.children.items()):
+                    if child.count:
+                        lines.append('{}{} n={} avg={:.1f} ms'.format(
+                            name, _label_text(metric.label_names, key), child.count, child.sum / child.count * 1000))
+            else:
+                for sample, labels, value in metric._samples():
+                    if value:
+                        lines.append('{}{} {}'.format(
+                            sample, _label_text(labels.keys(), labels.values()), _number(value)))
+        return lines
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _label_text(names, values):
+    pairs = ['{}={}'.format(k, v) for k, v in zip(names, values) if v]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_reporter = None
+
+
+def serve(host, port):
+    """
+    Exposes the metrics on http://host:port/metrics from a daemon thread.
+    """
+    global _server
+    if _server is None:
+        _server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('serving metrics on http://{}:{}/metrics'.format(host, _server.server_port))
+    return _server
+
+
+def report_every(interval, stop=None):
+    """
+    Logs the summary every interval seconds from a daemon thread until stop is set.
+    """
+    global _reporter
+    stop = stop or threading.Event()
+
+    def report():
+        while not stop.wait(interval):
+            lines = REGISTRY.summary()
+            if lines:
+                logger.info('summary\n  ' + '\n  '.join(lines))
+
+    if _reporter is None:
+        _reporter = threading.Thread(target=report, name='metrics report', daemon=True)
+        _reporter.start()
+    return _reporter
@@ -0,0 +1,103 @@
+import functools
+
+from bs4 import BeautifulSoup, UnicodeDammit
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+
+class SoupBackend:
+    """
+    Reference backend on top of BeautifulSoup and the pure python html.parser.
+    """
+    name = 'bs4'
+
+    def rows(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup.body.find_all('a', class_='item_row')
+
+    @staticmethod
+    def attr(node, name):
+        return node.attrs.get(name)
+
+    @staticmethod
+    def find(node, tag, cls):
+        return node.find(tag, class_=cls)
+
+    @staticmethod
+    def find_all(node, tag):
+        return node.find_all(tag)
+
+    @staticmethod
+    def text(node):
+        return node.text
+
+    @staticmethod
+    def dump(node):
+        return node.prettify()
+
+
+class LxmlBackend:
+    """
+    Fast backend on top of libxml2. Class selectors are compiled to XPath once and reused for every row.
+    """
+    name = 'lxml'
+
+    def __init__(self):
+        if lxml is None:
+            raise RuntimeError('parser_backend = lxml needs the lxml package')
+        self.selectors = {}
+        self.rows_selector = self._selector('a', 'item_row')
+
+    def _selector(self, tag, cls):
+        key = (tag, cls)
+        if key not in self.selectors:
+            if cls:
+                expr = './/{}[contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(tag, cls)
+            else:
+                expr = './/{}'.format(tag)
+            self.selectors[key] = etree.XPath(expr)
+        return self.selectors[key]
+
+    def document(self, html):
+        if isinstance(html, bytes):
+            try:
+                html = html.decode('utf-8')
+            except UnicodeDecodeError:
+                html = UnicodeDammit(html).unicode_markup
+        return lxml.html.document_fromstring(html)
+
+    def rows(self, html):
+        return self.rows_selector(self.document(html).body)
+
+    @staticmethod
+    def attr(node, name):
+        return node.get(name)
+
+    def find(self, node, tag, cls):
+        found = self._selector(tag, cls)(node)
+        return found[0] if found else None
+
+    def find_all(self, node, tag):
+        return self._selector(tag, None)(node)
+
+    @staticmethod
+    def text(node):
+        return str(node.text_content())
+
+    @staticmethod
+    def dump(node):
+        return lxml.html.tostring(node, pretty_print=True, encoding='unicode')
+
+
+BACKENDS = {backend.name: backend for backend in (SoupBackend, LxmlBackend)}
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('unknown parser backend {}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+    return BACKENDS[name]()
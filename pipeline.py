@@ -0,0 +1,108 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+
+import metrics
+
+QUEUE_DEPTH = metrics.gauge('tori_pipeline_queue_depth', 'Items waiting in a pipeline stage inbox', ['stage'])
+
+_END = object()
+
+
+class Stage(threading.Thread):
+    """
+    Worker thread that takes items from a bounded inbox, hands them to func in micro-batches of at most
+    batch_size items or whatever arrived within max_wait seconds, and forwards the returned items to the
+    inboxes of the following stages. Every stage has a single predecessor.
+    """
+    def __init__(self, name, func, batch_size=50, max_wait=1.0, queue_size=1000):
+        super().__init__(name=name, daemon=True)
+        self.logger = logging.getLogger('stage ' + name)
+        self.func = func
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.inbox = queue.Queue(queue_size)
+        self.next = []
+        self.processed = 0
+
+    def then(self, stage):
+        self.next.append(stage)
+        return stage
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def close(self):
+        self.inbox.put(_END)
+
+    def _next_batch(self):
+        item = self.inbox.get()
+        if item is _END:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.inbox.get(timeout=remaining) if remaining > 0 else self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def run(self):
+        done = False
+        while not done:
+            batch, done = self._next_batch()
+            QUEUE_DEPTH.set(self.inbox.qsize(), stage=self.name)
+            if not batch:
+                continue
+            try:
+                result = self.func(batch)
+            except Exception:
+                self.logger.error('failed to process {} items'.format(len(batch)))
+                self.logger.error(traceback.format_exc())
+                result = None
+            self.processed += len(batch)
+            for stage in self.next:
+                for item in result or ():
+                    stage.put(item)
+        for stage in self.next:
+            stage.close()
+
+
+class Pipeline:
+    """
+    Stages fed from the calling thread. Items put into the pipeline go to every entry stage.
+    """
+    def __init__(self, *entries):
+        self.entries = entries
+        self.stages = []
+        for stage in entries:
+            self._collect(stage)
+
+    def _collect(self, stage):
+        if stage in self.stages:
+            return
+        self.stages.append(stage)
+        for following in stage.next:
+            self._collect(following)
+
+    def __enter__(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def put(self, item):
+        for stage in self.entries:
+            stage.put(item)
+
+    def __exit__(self, type, value, traceback):
+        for stage in self.entries:
+            stage.close()
+        for stage in self.stages:
+            stage.join()
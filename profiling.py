@@ -0,0 +1,94 @@
+import contextlib
+import cProfile
+import logging
+import os
+import threading
+from pathlib import Path
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+import config
+import metrics
+
+logger = logging.getLogger('profiling')
+
+# decided once at import, with timing off the decorated functions are the original ones
+TIMING = config.profile_timing or os.environ.get('TORI_TIMING', '') not in ('', '0')
+
+FUNCTION_SECONDS = metrics.histogram('tori_function_seconds', 'Duration of functions marked with profiling.timed',
+                                     ['function'])
+
+
+def timed(func):
+    """
+    Observes the duration of every call in tori_function_seconds when timing is enabled, returns func untouched
+    otherwise.
+    """
+    if not TIMING:
+        return func
+    return FUNCTION_SECONDS.timed(function=func.__qualname__)(func)
+
+
+class CycleProfiler:
+    """
+    Profiles the first cycles polls of every topic, one output file per poll. Uses pyinstrument when it is
+    installed (html and speedscope json), cProfile otherwise (.pstats, readable by snakeviz or flameprof). Only
+    the polling thread is profiled, time spent waiting on fetch and parse workers shows up as waits.
+    """
+    def __init__(self, out_dir, cycles, sampling=True):
+        self.out_dir = Path(out_dir)
+        self.cycles = cycles
+        self.sampling = sampling and pyinstrument is not None
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    def _next_cycle(self, name):
+        with self.lock:
+            cycle = self.counts.get(name, 0)
+            if cycle >= self.cycles:
+                return None
+            self.counts[name] = cycle + 1
+            return cycle
+
+    def done(self, names):
+        with self.lock:
+            return all(self.counts.get(name, 0) >= self.cycles for name in names)
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        cycle = self._next_cycle(name)
+        if cycle is None:
+            yield
+            return
+        stem = self.out_dir / '{}-{:03d}'.format(name.replace('/', '_'), cycle)
+        if self.sampling:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                stem.with_suffix('.html').write_text(profiler.output_html())
+                self._write_speedscope(profiler, stem.with_suffix('.speedscope.json'))
+                logger.info('wrote {}.html'.format(stem))
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(str(stem.with_suffix('.pstats')))
+                logger.info('wrote {}.pstats'.format(stem))
+
+    @staticmethod
+    def _write_speedscope(profiler, path):
+        try:
+            from pyinstrument.renderers import SpeedscopeRenderer
+        except ImportError:
+            return
+        path.write_text(profiler.output(SpeedscopeRenderer()))
@@ -0,0 +1,65 @@
+import datetime
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+
+# magic, format version, item count, unix time of writing
+_HEADER = struct.Struct('<4sHIq')
+# toriid, price, seconds since _EPOCH of the listing date
+_RECORD = struct.Struct('<qiq')
+_MAGIC = b'TSNP'
+_VERSION = 1
+_NONE_PRICE = -2 ** 31
+_NONE_DATE = -2 ** 63
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+logger = logging.getLogger('snapshot')
+
+
+def save(path, items):
+    """
+    Writes the toriid, price and date of items to path. The file is replaced atomically so a crash while writing
+    leaves the previous snapshot in place.
+    """
+    path = Path(path)
+    buf = bytearray(_HEADER.size + _RECORD.size * len(items))
+    _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, len(items), int(time.time()))
+    offset = _HEADER.size
+    for item in items:
+        price = item.price if isinstance(item.price, int) and -2 ** 31 < item.price < 2 ** 31 else _NONE_PRICE
+        date = (item.date - _EPOCH) // datetime.timedelta(seconds=1) if item.date is not None else _NONE_DATE
+        _RECORD.pack_into(buf, offset, item.toriid, price, date)
+        offset += _RECORD.size
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load(path, item_class):
+    """
+    Returns the items of a snapshot written by save() in their original order, None if there is no usable one.
+    """
+    try:
+        data = Path(path).read_bytes()
+    except FileNotFoundError:
+        return None
+    if len(data) < _HEADER.size:
+        logger.warning('ignoring truncated snapshot {}'.format(path))
+        return None
+    magic, version, count, written = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION or len(data) != _HEADER.size + count * _RECORD.size:
+        logger.warning('ignoring unknown or damaged snapshot {}'.format(path))
+        return None
+    items = []
+    for toriid, price, date in _RECORD.iter_unpack(memoryview(data)[_HEADER.size:]):
+        items.append(item_class.from_key(toriid,
+                                         None if price == _NONE_PRICE else price,
+                                         None if date == _NONE_DATE else _EPOCH + datetime.timedelta(seconds=date)))
+    logger.info('restored {} items from {} written {:.0f} s ago'.format(count, path, time.time() - written))
+    return items
@@ -1,4 +1,10 @@
 import datetime
+import logging
+
+from alarms import AlarmMatcher
+from items import ToriItem
+
+filter_logger = logging.getLogger('test')
 
 
 def run():
@@ -12,17 +18,18 @@ def run():
                     'MinPrice': None,
                     'UserId': 1,
                     'Location': 'Pohjois-savo'}]
-    test_items = [{'id': 42464586,
-                   'description': 'Sivuverhot',
-                   'location': 'Pohjois-Savo',
-                   'buy_or_sell': 'Myydään',
-                   'price': 50,
-                   'date': datetime.datetime(2017, 12, 2, 22, 46),
-                   'image_url': 'https://d38a5rkle4vfil.cloudfront.net/image/lithumbs/02/0282065103.jpg',
-                   'tori_url': 'https://www.tori.fi/pohjois-savo/Sivuverhot_42464586.htm',
-                   'category': 'Sisustus ja huonekalut'}]
-
-    items_check_for_alarm(test_items, test_alarms, True)
+    test_items = [ToriItem(**{'toriid': 42464586,
+                              'description': 'Sivuverhot',
+                              'location': 'Pohjois-Savo',
+                              'buy_or_sell': 'Myydään',
+                              'price': 50,
+                              'date': datetime.datetime(2017, 12, 2, 22, 46),
+                              'imageurl': 'https://d38a5rkle4vfil.cloudfront.net/image/lithumbs/02/0282065103.jpg',
+                              'toriurl': 'https://www.tori.fi/pohjois-savo/Sivuverhot_42464586.htm',
+                              'category': 'Sisustus ja huonekalut'})]
+
+    for item, alarm in AlarmMatcher(test_alarms).match(test_items):
+        filter_logger.info('alarm {} matched {}'.format(alarm['AlarmId'], item))
 
 
 if __name__ == '__main__':
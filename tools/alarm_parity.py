@@ -0,0 +1,95 @@
+"""
+Checks that AlarmMatcher finds the same (item, alarm) pairs as testing every alarm against every item, for random
+alarms built from literals, classes, groups, escapes and quantifiers. Exits with a non-zero status on any
+difference.
+
+    python tools/alarm_parity.py [--alarms N] [--items N] [--seed N]
+"""
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from alarms import AlarmMatcher, _Alarm, _required_literal
+
+# a small alphabet, so random descriptions match random patterns often
+ALPHABET = 'ab1 äİıſK'
+ATOMS = ['a', 'b', '1', ' ', 'ä', 'i', 's', 'k', 'ab', 'ba1', 'aab', '.', '[ab]', '[^a]', '[^]a]', '\\d', '\\w',
+         '\\x61', '\\u0062', '\\N{LATIN SMALL LETTER A}', '(a)', '(?:ab)', '(b)?', '\\.', '{', '{a}', '}']
+QUANTIFIERS = ['', '', '', '*', '+', '?', '{0}', '{1}', '{2}', '{0,2}', '{1,}', '{,2}', '{2,3}', '*?', '{1,2}?']
+PREFIXES = ['', '', '.*', '^', '(?i)', '(?x)']
+SUFFIXES = ['', '', '.*', '$', '|zz', '(a)\\1']
+
+
+def random_pattern(rnd):
+    pattern = rnd.choice(PREFIXES)
+    for _ in range(rnd.randint(1, 5)):
+        pattern += rnd.choice(ATOMS) + rnd.choice(QUANTIFIERS)
+    return pattern + rnd.choice(SUFFIXES)
+
+
+def random_alarms(rnd, n):
+    rows = []
+    while len(rows) < n:
+        pattern = random_pattern(rnd)
+        try:
+            re.compile(pattern)
+        except re.error:
+            continue
+        rows.append({'AlarmId': len(rows), 'UserId': rnd.randint(0, n // 4), 'SearchPattern': pattern,
+                     'Location': rnd.choice([None, None, 'hel', 'kuopio']),
+                     'MaxPrice': rnd.choice([None, 0, 50, 100]), 'MinPrice': rnd.choice([None, 0, 10, 50]),
+                     'PriceDropOnly': rnd.random() < 0.1})
+    return rows
+
+
+def random_items(rnd, n):
+    return [SimpleNamespace(description=''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 10))),
+                            location=rnd.choice(['Helsinki', 'Kuopio', 'Tampere']),
+                            price=rnd.choice([None, 'x', 0, 10, 49, 50, 51, 100, 200]),
+                            change=rnd.choice(['new', 'new', 'price_drop', 'price_change', 'relist']))
+            for _ in range(n)]
+
+
+def brute_force(rows, items):
+    alarms = [_Alarm(row) for row in rows]
+    matches = []
+    for item in items:
+        users = set()
+        for alarm in alarms:
+            if alarm.user_id not in users and alarm.matches(item):
+                users.add(alarm.user_id)
+                matches.append((item, alarm.row))
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare AlarmMatcher with a scan of every alarm')
+    parser.add_argument('--alarms', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    rows = random_alarms(rnd, args.alarms)
+    items = random_items(rnd, args.items)
+    expected = brute_force(rows, items)
+    found = AlarmMatcher(rows).match(items)
+    if found == expected:
+        print('ok, {} matches'.format(len(found)))
+        return 0
+    missing = [(item, row) for item, row in expected if (item, row) not in found]
+    extra = [(item, row) for item, row in found if (item, row) not in expected]
+    print('differs, {} matches vs {} by scanning, {} missing, {} extra'.format(
+        len(found), len(expected), len(missing), len(extra)))
+    for item, row in (missing + extra)[:20]:
+        print('  {!r} literal {!r} on {!r}'.format(row['SearchPattern'], _required_literal(row['SearchPattern']),
+                                                   item.description))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,384 @@
+"""
+Offline benchmarks for the scraper hot paths, no network or database needed. Listing and detail pages come from
+tools/fixtures, the database is DummyDBConnection, or a temporary SQLite file for the sqlite cases. Run it from the
+repository root.
+
+    python tools/benchmark.py [benchmark ...] [--json results.json] [--compare baseline.json]
+
+With --compare the run fails when a case is more than --threshold slower than in the baseline.
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import config
+from consumer import ToriParser, CarParser
+from database import ToriSQLDB, DummyDBConnection, SQLiteDB, SQLiteConnection
+from dates import FinnishDateParser
+from items import ToriItem, ToriItemList
+from parser_backends import BACKENDS
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+
+class LegacyItem:
+    """
+    Item with a per instance __dict__ as ToriItem was before __slots__, kept for comparison.
+    """
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            self.__setattr__(k.lower(), v)
+        self.hash = hash((self.toriid, self.price))
+
+
+def legacy_convert_date(d):
+    # ToriItem._convert_date before dates.FinnishDateParser, kept for comparison
+    months_fin = {1: 'tam', 2: 'hel', 3: 'maa', 4: 'huh', 5: 'tou', 6: 'kes',
+                  7: 'hei', 8: 'elo', 9: 'syy', 10: 'lok', 11: 'mar', 12: 'jou'}
+    months_fin2en = {'tam': 'Jan', 'hel': 'Feb', 'maa': 'Mar', 'huh': 'Apr', 'tou': 'May', 'kes': 'Jun',
+                     'hei': 'Jul', 'elo': 'Aug', 'syy': 'Sep', 'lok': 'Oct', 'mar': 'Nov', 'jou': 'Dec'}
+    today = datetime.date.today()
+    yesterday = datetime.date.today() - datetime.timedelta(1)
+
+    if 'tänään' in d:
+        d = '{} {} {}'.format(today.day, months_fin[today.month], d.split()[1])
+    if 'eilen' in d:
+        d = '{} {} {}'.format(yesterday.day, months_fin[yesterday.month], d.split()[1])
+    date_split = d.split()
+    d = '{} {} {}'.format(date_split[0], months_fin2en[date_split[1]], date_split[2])
+    return datetime.datetime.strptime(d, '%d %b %H:%M').replace(year=today.year)
+
+
+def raw_dates(n, seed=1):
+    """
+    Listing dates as they repeat across a scrape: mostly today and yesterday, a tail of older days.
+    """
+    rnd = random.Random(seed)
+    months = ['tam', 'hel', 'maa', 'huh', 'tou', 'kes', 'hei', 'elo', 'syy', 'lok', 'mar', 'jou']
+    raw = []
+    for _ in range(n):
+        clock = '{:02d}:{:02d}'.format(rnd.randint(0, 23), rnd.randint(0, 59))
+        kind = rnd.random()
+        if kind < 0.5:
+            raw.append('tänään ' + clock)
+        elif kind < 0.8:
+            raw.append('eilen ' + clock)
+        else:
+            raw.append('{} {} {}'.format(rnd.randint(1, 28), rnd.choice(months), clock))
+    return raw
+
+
+def item_rows(n, seed=1):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    locations = ['Helsinki, Uusimaa', 'Kuopio, Pohjois-Savo', 'Tampere, Pirkanmaa', 'Oulu, Pohjois-Pohjanmaa']
+    categories = ['Sisustus ja huonekalut', 'Urheilu ja ulkoilu', 'Puhelimet ja tarvikkeet', 'Kodinkoneet']
+    rows = []
+    for i in range(n):
+        toriid = 40000000 + i
+        # strings read from the database are separate objects even when equal
+        rows.append((toriid, 'Myydään tavara numero {}'.format(i), rnd.randint(1, 1000),
+                     start + datetime.timedelta(minutes=i), 'https://img.tori.net/{}.jpg'.format(toriid),
+                     'https://www.tori.fi/uusimaa/tavara_{}.htm'.format(toriid),
+                     rnd.choice(categories).encode().decode(), rnd.choice(locations).encode().decode()))
+    return rows
+
+
+def best_of(func, number, repeat=3):
+    """
+    Seconds per call of func, the best of repeat rounds of number calls.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(name, seconds, unit, **extra):
+    print('{:<44} {:>12.1f} us/{}'.format(name, seconds * 1e6, unit))
+    return dict(name=name, seconds=seconds, unit=unit, **extra)
+
+
+def measure(make_rows, build):
+    """
+    Returns the build time and the memory still held by the built items once the source rows are gone.
+    """
+    rows = make_rows()
+    gc.collect()
+    start = time.perf_counter()
+    build(rows)
+    elapsed = time.perf_counter() - start
+    del rows
+    gc.collect()
+    tracemalloc.start()
+    result = build(make_rows())
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, retained, len(result)
+
+
+class BenchDB(ToriSQLDB):
+    """
+    ToriSQLDB on DummyDBConnection with a fixed set of alarms and no user emails, so nothing is mailed.
+    """
+    def __init__(self, alarm_rows=()):
+        self.alarm_rows = list(alarm_rows)
+        super().__init__(DummyDBConnection)
+
+    def get_alarms(self):
+        return self.alarm_rows
+
+    def get_emails(self, user_ids):
+        return {}
+
+
+def alarm_rows(n, seed=1):
+    """
+    A mix of the alarm kinds users create: literal and regex searches, price limits and location only alarms.
+    """
+    rnd = random.Random(seed)
+    words = ['sohva', 'polkupyörä', 'iphone', 'jääkaappi', 'nahkatakki', 'lautapeli', 'kahvinkeitin', 'volvo',
+             'toyota', 'golf', 'sivuverhot', 'talvihaalari', 'kirja', 'suksi', 'luistimet', 'pöytä']
+    rows = []
+    for i in range(n):
+        kind = rnd.random()
+        row = {'AlarmId': i, 'UserId': i % 50, 'SearchPattern': None, 'Location': None,
+               'MaxPrice': None, 'MinPrice': None}
+        word = rnd.choice(words) + ('' if i < len(words) else str(i))
+        if kind < 0.6:
+            row['SearchPattern'] = word
+        elif kind < 0.8:
+            row['SearchPattern'] = '.*' + word
+        elif kind < 0.9:
+            row['SearchPattern'] = word[:3] + '.*'
+            row['Location'] = rnd.choice(['Helsinki', 'Kuopio', 'Tampere'])
+        else:
+            row['Location'] = rnd.choice(['Helsinki', 'Kuopio', 'Tampere']) + str(i)
+        if rnd.random() < 0.5:
+            row['MaxPrice'] = rnd.randint(50, 1000)
+        rows.append(row)
+    return rows
+
+
+def listing_items(n):
+    """
+    n items parsed from the listing fixtures, repeated with fresh toriids.
+    """
+    parsed = []
+    for path in sorted(FIXTURES.glob('listing_*.html')):
+        parsed.extend(ToriParser('bs4').parse(path.read_bytes()).items)
+    items = []
+    for i in range(n):
+        item = parsed[i % len(parsed)]
+        copy = ToriItem.from_key(50000000 + i, item.price, item.date)
+        for field in ('description', 'location', 'category', 'buy_or_sell', 'toriurl', 'imageurl'):
+            setattr(copy, field, getattr(item, field))
+        items.append(copy)
+    return items
+
+
+def bench_items(n=100000):
+    def dict_rows():
+        return [dict(zip(ToriItem.row_fields, row)) for row in item_rows(n)]
+
+    cases = [('legacy dict item from dict', dict_rows, lambda rows: [LegacyItem(**row) for row in rows]),
+             ('ToriItem from dict', dict_rows, lambda rows: [ToriItem(**row) for row in rows]),
+             ('ToriItem.from_row from tuple', lambda: item_rows(n), lambda rows: [ToriItem.from_row(row) for row in rows])]
+    results = []
+    for name, make_rows, build in cases:
+        elapsed, retained, count = measure(make_rows, build)
+        results.append(result('items: ' + name, elapsed / count, 'item', bytes_per_item=retained / count))
+    return results
+
+
+def bench_dates(n=100000):
+    raw = raw_dates(n)
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(1)
+    cases = [('legacy strptime', legacy_convert_date),
+             ('FinnishDateParser uncached', lambda d: FinnishDateParser._parse(d, today, yesterday)),
+             ('FinnishDateParser memoized', FinnishDateParser()),
+             ('ToriItem._convert_date', ToriItem._convert_date)]
+    results = []
+    for name, convert in cases:
+        seconds = best_of(lambda: [convert(d) for d in raw], 1) / n
+        results.append(result('dates: ' + name, seconds, 'date'))
+    return results
+
+
+def bench_parse(number=20):
+    results = []
+    for path in sorted(FIXTURES.glob('listing_*.html')):
+        html = path.read_bytes()
+        for backend in BACKENDS:
+            try:
+                parser = ToriParser(backend)
+            except RuntimeError as e:
+                print('parse: {} skipped, {}'.format(backend, e))
+                continue
+            seconds = best_of(lambda: parser.parse(html), number)
+            results.append(result('parse: {} {}'.format(backend, path.stem), seconds, 'page',
+                                  items=len(parser.parse(html))))
+    return results
+
+
+def bench_enrich(number=200):
+    html = (FIXTURES / 'detail_car.html').read_bytes()
+    parser = CarParser()
+    item = parser.parse((FIXTURES / 'listing_autot.html').read_bytes())[0]
+    seconds = best_of(lambda: parser.enrich(lambda url, user_msg=None: html, item), number)
+    return [result('enrich: CarParser.enrich', seconds, 'item')]
+
+
+def bench_diff(keep=8000, cycles=200, per_cycle=40):
+    """
+    Steady state of the seen window: every cycle diffs a fetch with per_cycle new items against it, adds them
+    and evicts as many old ones.
+    """
+    start = datetime.datetime(2020, 1, 1)
+
+    def fetch(cycle):
+        fetched = ToriItemList('fetch')
+        # half of a fetch is already known, like the tail of the newest listing page
+        known = [ToriItem.from_key(keep + (cycle - 1) * per_cycle + i, 10, start + datetime.timedelta(
+            minutes=keep + (cycle - 1) * per_cycle + i)) for i in range(per_cycle)]
+        new = [ToriItem.from_key(keep + cycle * per_cycle + i, 10, start + datetime.timedelta(
+            minutes=keep + cycle * per_cycle + i)) for i in range(per_cycle)]
+        fetched.items = known + new
+        return fetched
+
+    fetches = [fetch(cycle) for cycle in range(cycles)]
+    old = ToriItemList('old')
+    old.items = [ToriItem.from_key(i, 10, start + datetime.timedelta(minutes=i)) for i in range(keep)]
+    old.truncate_oldest(keep)
+    diff_time = truncate_time = 0.0
+    for fetched in fetches:
+        t0 = time.perf_counter()
+        diff = old.diff_to(fetched, keep)
+        old += diff
+        t1 = time.perf_counter()
+        old.truncate_oldest(keep)
+        truncate_time += time.perf_counter() - t1
+        diff_time += t1 - t0
+    return [result('diff: diff_to and add {} of {}'.format(per_cycle * 2, keep), diff_time / cycles, 'cycle'),
+            result('diff: truncate_oldest {} of {}'.format(per_cycle, keep), truncate_time / cycles, 'cycle')]
+
+
+def bench_alarms(counts=(10, 100, 1000), n=400):
+    items = ToriItemList('new')
+    items.items = listing_items(n)
+    results = []
+    for count in counts:
+        items.db = BenchDB(alarm_rows(count))
+        items.check_for_alarms()
+        seconds = best_of(items.check_for_alarms, 5)
+        results.append(result('alarms: check_for_alarms {} alarms'.format(count), seconds / n, 'item'))
+    return results
+
+
+def bench_store(n=10000):
+    db = BenchDB()
+    items = listing_items(n)
+    seconds = best_of(lambda: db.store_items(items), 5)
+    return [result('store: store_items rows', seconds / n, 'item')]
+
+
+def bench_sqlite(n=10000):
+    with tempfile.TemporaryDirectory() as tmp:
+        config.sqlite_path = str(Path(tmp, 'bench.sqlite3'))
+        db = SQLiteDB(SQLiteConnection)
+        items = listing_items(n)
+        start = time.perf_counter()
+        db.store_items(items)
+        insert = time.perf_counter() - start
+        upsert = best_of(lambda: db.store_items(items), 3)
+        for item in items:
+            item.price, item.prev_price, item.change = (item.price or 0) + 1, item.price, 'price_change'
+        changes = best_of(lambda: db.store_changes('Item', items), 3)
+        keys = best_of(lambda: db.get_item_keys('Item', n), 3)
+        SQLiteConnection.local.db.close()
+        SQLiteConnection.local.db = None
+    return [result('sqlite: store_items new rows', insert / n, 'item'),
+            result('sqlite: store_items existing rows', upsert / n, 'item'),
+            result('sqlite: store_changes rows', changes / n, 'item'),
+            result('sqlite: get_item_keys rows', keys / n, 'item')]
+
+
+BENCHMARKS = {
+    'items': bench_items,
+    'dates': bench_dates,
+    'parse': bench_parse,
+    'enrich': bench_enrich,
+    'diff': bench_diff,
+    'alarms': bench_alarms,
+    'store': bench_store,
+    'sqlite': bench_sqlite,
+}
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every case against the baseline run, returns the names of the regressed ones.
+    """
+    before = {r['name']: r['seconds'] for r in baseline['results']}
+    regressed = []
+    print('--- compared to {}'.format(baseline.get('time', 'baseline')))
+    for r in results:
+        if r['name'] not in before or not before[r['name']]:
+            continue
+        change = r['seconds'] / before[r['name']] - 1
+        flag = ''
+        if change > threshold:
+            regressed.append(r['name'])
+            flag = '  REGRESSION'
+        print('{:<44} {:>+8.1%}{}'.format(r['name'], change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the scraper hot paths')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of {}, all by default'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown counted as a regression, 0.2 is 20%% (default)')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark {}'.format(', '.join(unknown)))
+
+    # the alarm and database code logs every match and missing table
+    logging.getLogger().setLevel(logging.ERROR)
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        print('--- {}'.format(name))
+        results.extend(BENCHMARKS[name]())
+    run = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+           'machine': platform.machine(), 'results': results}
+    if args.json:
+        Path(args.json).write_text(json.dumps(run, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+End-to-end load test of the full toriscraper.run loop against a synthetic local tori.fi. The server publishes new
+ads at a configurable rate and serves listing pages (/koko_suomi?o=N, /koko_suomi/autot?o=N) and car detail
+pages with optional latency, errors and throttling. Alarms go to an in-memory database and are never mailed.
+
+    python tools/loadtest.py [--rate 5] [--duration 120] [--latency 0.05] [--error-rate 0.01] ...
+    python tools/loadtest.py --serve --port 8080      # only run the server, point base_url at it
+
+Every topic first finishes its cold first poll over the backlog, the measurement window of --duration seconds starts
+after that. Reports sustained items/s and the p50/p99 time from an ad being published to its alarm being stored.
+"""
+import argparse
+import datetime
+import html
+import http.server
+import random
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import config
+import writer
+from database import ToriSQLDB, DummyDBConnection, DBFactory
+
+MONTHS_FIN = ['tam', 'hel', 'maa', 'huh', 'tou', 'kes', 'hei', 'elo', 'syy', 'lok', 'mar', 'jou']
+WORDS = ['Sohva', 'Polkupyörä', 'Sivuverhot', 'Kahvinkeitin', 'Jääkaappi', 'Nahkatakki', 'Lautapeli', 'Suksisetti',
+         'Työpöytä', 'Luistimet']
+CARS = ['Volvo V70 D5', 'Toyota Avensis 2.0', 'Volkswagen Golf 1.6 TDI', 'Skoda Octavia Combi', 'Ford Focus 1.8']
+CITIES = [('Helsinki', 'Uusimaa'), ('Kuopio', 'Pohjois-Savo'), ('Tampere', 'Pirkanmaa'), ('Oulu', 'Pohjois-Pohjanmaa')]
+PAGE_SIZE = 40
+
+
+class Ad:
+
+    __slots__ = ('toriid', 'description', 'price', 'city', 'region', 'category', 'published', 'date')
+
+    def __init__(self, toriid, description, price, city, region, category, published, date):
+        self.toriid = toriid
+        self.description = description
+        self.price = price
+        self.city = city
+        self.region = region
+        self.category = category
+        # monotonic time for latency, wall clock minute for the listing
+        self.published = published
+        self.date = date
+
+
+class Market:
+    """
+    Ads of one listing, newest first. New ads are published at rate per second, plus a backlog of older ones.
+    """
+    def __init__(self, path, cars, rate, backlog, first_id, seed):
+        self.path = path
+        self.cars = cars
+        self.rate = rate
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ads = []
+        self.by_id = {}
+        self.next_id = first_id
+        self.start = time.monotonic()
+        self.published = 0
+        now = datetime.datetime.now()
+        for i in range(backlog, 0, -1):
+            self._publish(self.start - i * 60, now - datetime.timedelta(minutes=i))
+
+    def _publish(self, published, date):
+        city, region = self.rnd.choice(CITIES)
+        description = self.rnd.choice(CARS if self.cars else WORDS)
+        category = 'Autot' if self.cars else 'Sisustus ja huonekalut'
+        price = self.rnd.randint(1000, 20000) if self.cars else self.rnd.randint(1, 900)
+        ad = Ad(self.next_id, description, price, city, region, category, published, date)
+        self.next_id += 1
+        self.ads.append(ad)
+        self.by_id[ad.toriid] = ad
+
+    def update(self):
+        with self.lock:
+            now = time.monotonic()
+            wall = datetime.datetime.now()
+            due = int((now - self.start) * self.rate)
+            while self.published < due:
+                self.published += 1
+                # published on schedule, not when the next request happens to look
+                published = self.start + self.published / self.rate
+                self._publish(published, wall - datetime.timedelta(seconds=now - published))
+
+    def page(self, num):
+        self.update()
+        with self.lock:
+            end = len(self.ads) - num * PAGE_SIZE
+            return list(reversed(self.ads[max(end - PAGE_SIZE, 0):max(end, 0)]))
+
+
+def _listing_date(date, today):
+    if date.date() == today:
+        day = 'tänään'
+    elif date.date() == today - datetime.timedelta(1):
+        day = 'eilen'
+    else:
+        day = '{} {}'.format(date.day, MONTHS_FIN[date.month - 1])
+    return '{}\n\t\t{}'.format(day, date.strftime('%H:%M'))
+
+
+def listing_html(base_url, ads):
+    today = datetime.date.today()
+    rows = []
+    for ad in ads:
+        title = html.escape('{}, {}, {}, {}'.format(ad.description, ad.category, ad.city, ad.region))
+        rows.append('''<a class="item_row item_row_flex" id="item_{id}" href="{base}{region}/{slug}_{id}.htm">
+ <div class="date_image">{date}</div>
+ <div class="item_image_div"><img class="item_image" src="https://img.tori.net/{id}.jpg" title="{title}"></div>
+ <div class="desc_flex"><div class="li-title">{description}</div>
+ <p class="list_price ineuros">{price} €</p>
+ <div class="cat_geo clean_links"><p>  {city}  </p><p> Myydään </p></div></div></a>'''.format(
+            id=ad.toriid, base=base_url, region=ad.region.lower(), slug=ad.description.split()[0],
+            date=_listing_date(ad.date, today), title=title, description=html.escape(ad.description),
+            price=ad.price, city=ad.city))
+    return ('<!DOCTYPE html><html lang="fi"><head><meta charset="utf-8"></head><body>'
+            '<div class="list_mode_thumb">' + '\n'.join(rows) + '</div></body></html>')
+
+
+def detail_html(ad):
+    topics = [('Ajoneuvotyyppi', 'Farmari'), ('Vuosimalli', str(2005 + ad.toriid % 15)),
+              ('Mittarilukema', '{} km'.format(50000 + ad.toriid % 200000)), ('Polttoaine', 'Diesel'),
+              ('Vaihteisto', 'Manuaali'), ('Ajoneuvovero', '412 €'), ('Rekisterinumero', 'ABC-{}'.format(ad.toriid % 1000)),
+              ('Vakionopeudensäädin', 'Kyllä'), ('Vetokoukku', '-'), ('Ilmastointi', 'Kyllä'), ('Lohkolämmitin', 'Kyllä')]
+    rows = '\n'.join('<tr>\n<td class="topic">{}:</td>\n<td class="value">{}</td>\n</tr>'.format(k, v) for k, v in topics)
+    return ('<!DOCTYPE html><html lang="fi"><head><meta charset="utf-8"></head><body>'
+            '<img class="image_next" src="https://img.tori.net/{id}.jpg"/>'
+            '<div class="sub_subject"><div class="ad_param">{description}</div></div>'
+            '<div class="body">\n  Myydään {description}.\n</div>'
+            '<table>{rows}</table></body></html>').format(id=ad.toriid, description=html.escape(ad.description),
+                                                          rows=rows)
+
+
+class FakeTori(http.server.ThreadingHTTPServer):
+    """
+    Serves the markets with latency seconds of delay on average, error_rate of 503 responses and 429 with
+    Retry-After when more than throttle requests arrive within a second.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, markets, latency=0.0, error_rate=0.0, throttle=0):
+        super().__init__(address, _Handler)
+        self.markets = markets
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.window = []
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.base_url = 'http://{}:{}/'.format(*self.server_address[:2])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake tori', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _admit(self):
+        """
+        Returns the status to fail the request with, None to serve it.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            if self.throttle:
+                self.window = [t for t in self.window if now - t < 1]
+                self.window.append(now)
+                if len(self.window) > self.throttle:
+                    self.throttled += 1
+                    return 429
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return 503
+        return None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    DETAIL = re.compile(r'_(\d+)\.htm')
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        status = server._admit()
+        if status:
+            self._send(status, b'', {'Retry-After': '1'} if status == 429 else {})
+            return
+        path, _, query = self.path.partition('?')
+        detail = self.DETAIL.search(path)
+        if detail:
+            ad = None
+            for market in server.markets.values():
+                ad = market.by_id.get(int(detail.group(1))) or ad
+            if ad is None:
+                self._send(404, b'')
+            else:
+                self._send(200, detail_html(ad).encode())
+            return
+        market = server.markets.get(path.rstrip('/'))
+        if market is None:
+            self._send(404, b'')
+            return
+        page = re.search(r'o=(\d+)', query)
+        self._send(200, listing_html(server.base_url, market.page(int(page.group(1)) if page else 0)).encode())
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HarnessDB(ToriSQLDB):
+    """
+    Database that keeps only counts, serves fixed alarms and records when each ad's alarm was stored.
+    """
+    def __init__(self, alarm_rows, markets):
+        self.alarm_rows = alarm_rows
+        self.markets = markets
+        self.lock = threading.Lock()
+        self.stored = 0
+        self.latencies = []
+        self.alarmed = set()
+        # only ads published from this point on count for the latencies
+        self.since = time.monotonic()
+        super().__init__(DummyDBConnection)
+
+    def get_alarms(self):
+        return self.alarm_rows
+
+    def get_emails(self, user_ids):
+        return {user_id: 'load{}@example.invalid'.format(user_id) for user_id in user_ids}
+
+    def store_item_alarms(self, alarms):
+        now = time.monotonic()
+        with self.lock:
+            for _, item in alarms:
+                if item.toriid in self.alarmed:
+                    continue
+                self.alarmed.add(item.toriid)
+                for market in self.markets.values():
+                    ad = market.by_id.get(item.toriid)
+                    # ads of the backlog and those found by the warm-up poll are not measured
+                    if ad is not None and ad.published >= self.since:
+                        self.latencies.append(now - ad.published)
+
+    def _count(self, items):
+        with self.lock:
+            self.stored += len(items)
+
+    def store_items(self, items):
+        self._count(items)
+
+    def store_cars(self, items):
+        self._count(items)
+
+    def store_changes(self, table, items):
+        self._count(items)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def published_ads(markets):
+    # markets publish when a page is requested, bring them up to now first
+    for market in markets.values():
+        market.update()
+    return sum(market.published for market in markets.values())
+
+
+def make_markets(rate, backlog, seed=1):
+    return {'/koko_suomi': Market('/koko_suomi', False, rate, backlog, 60000000, seed),
+            '/koko_suomi/autot': Market('/koko_suomi/autot', True, rate / 4, backlog // 4, 40000000, seed + 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test toriscraper against a synthetic local tori.fi')
+    parser.add_argument('--rate', type=float, default=5, help='new ads per second in koko_suomi, a quarter of '
+                                                                'that in autot')
+    parser.add_argument('--backlog', type=int, default=4000, help='ads already listed when the test starts')
+    parser.add_argument('--duration', type=float, default=120, help='seconds to run the scraper for')
+    parser.add_argument('--latency', type=float, default=0.05, help='average response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--throttle', type=int, default=0, help='requests per second above which to send 429')
+    parser.add_argument('--alarm-every', type=int, default=1, help='alarm on every ad whose description is one '
+                                                                   'of the first N words')
+    parser.add_argument('--min-interval', type=float, default=2)
+    parser.add_argument('--max-interval', type=float, default=30)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--serve', action='store_true', help='only run the server until interrupted')
+    args = parser.parse_args()
+
+    markets = make_markets(args.rate, args.backlog)
+    server = FakeTori((args.host, args.port), markets, args.latency, args.error_rate, args.throttle).start()
+    print('serving {}koko_suomi and {}koko_suomi/autot'.format(server.base_url, server.base_url))
+    if args.serve:
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            server.stop()
+        return
+
+    import toriscraper
+
+    words = [w.lower() for w in WORDS[:args.alarm_every]] + [c.split()[0].lower() for c in CARS[:args.alarm_every]]
+    alarm_rows = [{'AlarmId': i, 'UserId': i, 'SearchPattern': word, 'Location': None, 'MaxPrice': None,
+                   'MinPrice': None} for i, word in enumerate(words)]
+    db = HarnessDB(alarm_rows, markets)
+    DBFactory.instance = db
+    config.base_url = server.base_url
+    config.snapshot_dir = ''
+    config.journal_dir = ''
+    config.metrics_port = 0
+    # alarms are stored but never mailed
+    config.__dict__.pop('gmail_user', None)
+    config.__dict__.pop('gmail_pass', None)
+    config.topics = [config._read_topic('koko_suomi'), config._read_topic('autot', parser='car')]
+    for topic in config.topics:
+        topic.update(min_interval=args.min_interval, max_interval=args.max_interval, max_age=0)
+
+    stop = threading.Event()
+    scraper = threading.Thread(target=toriscraper.run, args=(stop,), name='scraper')
+    scraper.start()
+    warmup = time.monotonic()
+    # the cold first poll reads the whole backlog, measure only the steady state after it
+    while not all(toriscraper.CYCLE_SECONDS.labels(topic=topic['name']).count for topic in config.topics):
+        if not scraper.is_alive():
+            break
+        time.sleep(0.2)
+    # rows of the warm-up still queued for the background writer are not part of the measurement either
+    behind = writer.get(db)
+    while behind is not None and behind.backlog() and scraper.is_alive():
+        time.sleep(0.1)
+    start = time.monotonic()
+    with db.lock:
+        db.since = start
+        stored = db.stored
+    requests, errors, throttled = server.requests, server.errors, server.throttled
+    published = published_ads(markets)
+    print('warm-up took {:.0f} s'.format(start - warmup))
+    stop.wait(args.duration)
+    stop.set()
+    scraper.join()
+    elapsed = time.monotonic() - start
+    server.stop()
+
+    published = published_ads(markets) - published
+    stored = db.stored - stored
+    print('--- {:.0f} s, {} ads published, {} requests ({} errors, {} throttled)'.format(
+        elapsed, published, server.requests - requests, server.errors - errors, server.throttled - throttled))
+    print('stored       {:>8} items, {:.1f} items/s'.format(stored, stored / elapsed))
+    print('alarms       {:>8} ads, {} of them published after the warm-up'.format(len(db.alarmed), len(db.latencies)))
+    print('ad -> alarm  p50 {:.1f} s, p99 {:.1f} s, max {:.1f} s'.format(
+        percentile(db.latencies, 50), percentile(db.latencies, 99), max(db.latencies, default=float('nan'))))
+
+
+if __name__ == '__main__':
+    main()
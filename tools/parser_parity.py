@@ -0,0 +1,49 @@
+"""
+Checks that every parser backend produces the same items as the BeautifulSoup reference backend for the
+saved listing pages in tools/fixtures. Exits with a non-zero status on any difference.
+
+    python tools/parser_parity.py [fixture.html ...]
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from consumer import ToriParser
+from parser_backends import BACKENDS
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+FIELDS = ['toriid', 'description', 'price', 'date', 'imageurl', 'toriurl', 'location', 'buy_or_sell', 'category']
+
+
+def item_fields(items):
+    return [tuple(getattr(item, field) for field in FIELDS) for item in items]
+
+
+def compare(path):
+    html = path.read_bytes()
+    reference = item_fields(ToriParser('bs4').parse(html))
+    failures = 0
+    for name in BACKENDS:
+        if name == 'bs4':
+            continue
+        try:
+            parsed = item_fields(ToriParser(name).parse(html))
+        except RuntimeError as e:
+            print('{}: {} skipped, {}'.format(path.name, name, e))
+            continue
+        if parsed == reference:
+            print('{}: {} ok, {} items'.format(path.name, name, len(parsed)))
+            continue
+        failures += 1
+        print('{}: {} differs, {} items vs {} in reference'.format(path.name, name, len(parsed), len(reference)))
+        for ref, got in zip(reference, parsed):
+            for field, a, b in zip(FIELDS, ref, got):
+                if a != b:
+                    print('  {} {}: {!r} != {!r}'.format(ref[0], field, a, b))
+    return failures
+
+
+if __name__ == '__main__':
+    paths = [Path(p) for p in sys.argv[1:]] or sorted(FIXTURES.glob('listing_*.html'))
+    sys.exit(1 if sum(compare(path) for path in paths) else 0)
@@ -3,58 +3,259 @@
 
 import time
 import random
+import argparse
+import datetime
 import logging
+import threading
+import contextlib
+from pathlib import Path
 
-from consumer import ToriConsumer, CarParser, ToriParser
+import config
+import metrics
+import snapshot
+import writer
+from profiling import CycleProfiler
+from consumer import ToriConsumer, CarParser, ToriParser, close_parse_pool
 from database import DBFactory
+from fetcher import CachingFetcher, FetcherFactory, RateLimitedFetcher
+from pipeline import Pipeline, Stage
 
-NUM_PAGES_TO_SEARCH = 100
-NUM_KEEP_ITEMS = 8000
+PARSERS = {'tori': ToriParser, 'car': CarParser}
 
-def get_new_items(fetcher):
-    new_items = fetcher['consumer'].parser.list_factory('new', db=DBFactory.create())
-    for items in fetcher['consumer']:
-        diff_items = fetcher['old'].diff_to(items)
+CYCLE_SECONDS = metrics.histogram('tori_cycle_seconds', 'Duration of one poll of a topic', ['topic'])
+CYCLE_PAGES = metrics.histogram('tori_cycle_pages', 'Listing pages fetched in one poll', ['topic'],
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+NEW_ITEMS = metrics.counter('tori_new_items_total', 'New and changed items found', ['topic', 'change'])
+SEEN_ITEMS = metrics.gauge('tori_seen_items', 'Items in the window of already seen items', ['topic'])
+EVICTED_ITEMS = metrics.gauge('tori_evicted_items', 'Items evicted from the seen window since start', ['topic'])
+
+
+class Topic:
+    """
+    One scraped listing with its own consumer, window of already seen items and poll interval. The interval
+    follows the observed rate of new items so that about target_new_items are found per poll.
+    """
+    def __init__(self, conf):
+        self.logger = logging.getLogger('topic ' + conf['name'])
+        self.name = conf['name']
+        parser = PARSERS[conf['parser']]()
+        if conf['path'] is not None:
+            parser.topic = conf['path']
+        self.consumer = ToriConsumer(parser, conf['pages'])
+        self.keep = conf['keep']
+        self.max_age = datetime.timedelta(hours=conf['max_age']) if conf['max_age'] else None
+        self.min_interval = conf['min_interval']
+        self.max_interval = conf['max_interval']
+        self.target_new_items = conf['target_new_items']
+        self.interval = min(max(180, self.min_interval), self.max_interval)
+        self.rate = None
+        self.last_poll = None
+        self.old = None
+        self.snapshot_path = Path(config.snapshot_dir, self.name + '.snapshot') if config.snapshot_dir else None
+
+    def load(self):
+        self.old = self.consumer.parser.list_factory('old', db=DBFactory.create())
+        restored = snapshot.load(self.snapshot_path, self.old.item_class) if self.snapshot_path else None
+        if restored is not None:
+            self.old.items = restored
+            source = 'snapshot'
+        elif config.warm_start:
+            self.old.populate_keys(self.keep)
+            source = 'database keys'
+        else:
+            self.old.populate()
+            source = 'database'
+        self.logger.info('startup topic={}, {} items from {}, {}'.format(
+            self.consumer.parser.topic, len(self.old), source, _list_to_daterangetext(self.old)))
+
+    def save(self):
+        if self.snapshot_path and self.old is not None:
+            try:
+                snapshot.save(self.snapshot_path, self.old.items)
+            except OSError:
+                self.logger.exception('unable to write snapshot {}'.format(self.snapshot_path))
+
+    def poll(self):
+        start = time.monotonic()
+        paused = self.consumer.breaker.remaining()
+        if paused:
+            self.logger.warning('topic={} paused for {:.0f} s after repeated fetch errors'.format(
+                self.consumer.parser.topic, paused))
+            return
+        if config.pipeline:
+            new_items = stream_new_items(self)
+        else:
+            new_items = get_new_items(self)
+            new_items.check_for_alarms()
+            try:
+                new_items.persist()
+            except Exception:
+                # only with write_behind = no, the items are lost but the poll itself went fine
+                self.logger.exception('unable to store {} items'.format(len(new_items)))
+        if len(new_items):
+            self.logger.info(f'\n{new_items}')
+        self.save()
+        CYCLE_SECONDS.observe(time.monotonic() - start, topic=self.name)
+        CYCLE_PAGES.observe(self.consumer.pages_fetched, topic=self.name)
+        for item in new_items:
+            NEW_ITEMS.inc(topic=self.name, change=item.change or 'new')
+        SEEN_ITEMS.set(len(self.old), topic=self.name)
+        EVICTED_ITEMS.set(self.old.evicted, topic=self.name)
+        self.update_interval(len(new_items), start)
+        self.logger.info('topic={}, {}/{} items ({} added, {} evicted in total), {}, next poll in {:.0f} s'.format(
+            self.consumer.parser.topic, len(self.old), self.keep, len(new_items), self.old.evicted,
+            _list_to_daterangetext(self.old), self.interval))
+        self.logger.debug('db pool {}'.format(DBFactory.pool_stats()))
+        if isinstance(self.consumer.fetcher, RateLimitedFetcher):
+            self.logger.debug('fetcher {}'.format(self.consumer.fetcher.stats()))
+        if isinstance(self.consumer.detail_fetcher, CachingFetcher):
+            self.logger.debug('detail cache {}'.format(self.consumer.detail_fetcher.stats()))
+
+    def update_interval(self, new_count, now):
+        if self.last_poll is not None:
+            rate = new_count / max(now - self.last_poll, 1)
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+            if self.rate > 0:
+                interval = self.target_new_items / self.rate
+            else:
+                interval = self.interval * 1.5
+            self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.last_poll = now
+
+    def run(self, stop, profiler=None):
+        # a poll in progress stops fetching further pages as soon as stop is set
+        self.consumer.stop = stop
+        try:
+            self.load()
+            while not stop.is_set():
+                try:
+                    with profiler.profile(self.name) if profiler else contextlib.nullcontext():
+                        self.poll()
+                except KeyboardInterrupt:
+                    raise
+                except Exception:
+                    self.logger.exception('poll failed')
+                stop.wait(max(self.interval * random.uniform(0.9, 1.1), self.consumer.breaker.remaining()))
+        finally:
+            self.save()
+            self.logger.info('stopped')
+
+
+def get_new_items(topic):
+    new_items = topic.consumer.parser.list_factory('new', db=DBFactory.create())
+    topic.consumer.set_watermark(topic.old.newest_date())
+    for items in topic.consumer:
+        diff_items = topic.old.diff_to(items, topic.keep, topic.max_age)
         if len(diff_items) == 0:
             break
-        fetcher['old'] += diff_items
+        topic.old += diff_items
         new_items += diff_items
-    new_items.sort_by_date()
-    fetcher['consumer'].enrich(new_items)
-    fetcher['old'].truncate_oldest(NUM_KEEP_ITEMS)
+    new_items.items = new_items.sort_by_date()
+    topic.consumer.enrich(new_items)
+    topic.old.truncate_oldest(topic.keep, topic.max_age)
+    return new_items
+
+
+def stream_new_items(topic):
+    """
+    Same as get_new_items followed by check_for_alarms and persist, but new items are handed to the alarm check
+    and to enrichment as soon as their own page is parsed, without waiting for the other pages of its batch,
+    and persisted in micro-batches once enriched.
+    """
+    db = DBFactory.create()
+    list_factory = topic.consumer.parser.list_factory
+
+    def as_list(name, batch):
+        items = list_factory(name, db=db)
+        items.items = batch
+        return items
+
+    def check_for_alarms(batch):
+        as_list('alarm', batch).check_for_alarms()
+
+    def enrich(batch):
+        items = as_list('enrich', batch)
+        topic.consumer.enrich(items)
+        return items.items
+
+    def persist(batch):
+        as_list('persist', batch).persist()
+
+    options = {'batch_size': config.pipeline_batch, 'max_wait': config.pipeline_wait,
+               'queue_size': config.pipeline_queue}
+    alarms = Stage(topic.name + ' alarms', check_for_alarms, **options)
+    enricher = Stage(topic.name + ' enrich', enrich, **options)
+    enricher.then(Stage(topic.name + ' persist', persist, **options))
+
+    new_items = list_factory('new', db=db)
+    topic.consumer.set_watermark(topic.old.newest_date())
+    with Pipeline(alarms, enricher) as pipeline:
+        for pages in topic.consumer.batches():
+            # every page is diffed as soon as it is parsed, scanning stops after a batch without changes
+            found = 0
+            for items in pages:
+                diff_items = topic.old.diff_to(items, topic.keep, topic.max_age)
+                topic.old += diff_items
+                new_items += diff_items
+                for item in diff_items:
+                    pipeline.put(item)
+                found += len(diff_items)
+            if not found:
+                break
+    topic.old.truncate_oldest(topic.keep, topic.max_age)
     return new_items
 
 
 def _list_to_daterangetext(l):
-    if not l[0] or not l[-1]:
+    if not len(l):
         return 'timerange n/a'
-    return '{} - {}'.format(l[0].date, l[-1].date)
+    return '{} - {}'.format(l.oldest_date(), l.newest_date())
 
 
-def run():
+def run(stop=None, profiler=None):
     logger = logging.getLogger('main')
     logger.info('start tori.fi monitoring')
-    consumers = [
-        {'consumer': ToriConsumer(CarParser(), NUM_PAGES_TO_SEARCH)},
-        {'consumer': ToriConsumer(ToriParser(), NUM_PAGES_TO_SEARCH)}
-    ]
-
-    for c in consumers:
-        c['old'] = c['consumer'].parser.list_factory('old', db=DBFactory.create(), populate=True)
-        logger.info('startup topic={}, {}'.format(c['consumer'].parser.topic, _list_to_daterangetext(c['old'])))
-
-    while True:
-        for c in consumers:
-            new_items = get_new_items(c)
-            new_items.check_for_alarms()
-            new_items.persist()
-            if len(new_items):
-                logger.info(f'\n{new_items}')
-            logger.info('topic={}, {}/{} items ({} added), {}'.format(c['consumer'].parser.topic,
-                len(c['old']), NUM_KEEP_ITEMS, len(new_items), _list_to_daterangetext(c['old'])))
-        wait_time = 180 + random.randint(1, 60)
-        time.sleep(wait_time)
+    stop = stop or threading.Event()
+    if config.metrics_port:
+        metrics.serve(config.metrics_host, config.metrics_port)
+    if config.metrics_log_interval:
+        metrics.report_every(config.metrics_log_interval, stop)
+    # a journal left behind by a crash is replayed right away, not only once new items arrive
+    writer.get(DBFactory.create())
+    topics = [Topic(conf) for conf in config.topics]
+    threads = [threading.Thread(target=topic.run, args=(stop, profiler), name=topic.name, daemon=True)
+               for topic in topics]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+            if profiler and not stop.is_set() and profiler.done([topic.name for topic in topics]):
+                logger.info('profiled {} polls of every topic, stopping'.format(profiler.cycles))
+                stop.set()
+    except KeyboardInterrupt:
+        logger.info('stopping')
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        # queued rows are written now, whatever remains is replayed from the journal on the next start
+        writer.stop_all()
+        FetcherFactory.close()
+        close_parse_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetches Tori classifieds and sends alarms')
+    parser.add_argument('--profile', type=int, metavar='N', default=0,
+                        help='profile the first N polls of every topic, then stop')
+    parser.add_argument('--profile-dir', default='profiles', help='directory for the per-poll profiles')
+    parser.add_argument('--cprofile', action='store_true', help='use cProfile even when pyinstrument is installed')
+    args = parser.parse_args()
+    profiler = CycleProfiler(args.profile_dir, args.profile, sampling=not args.cprofile) if args.profile else None
+    run(profiler=profiler)
 
 
 if __name__ == '__main__':
-    run()
+    main()
@@ -0,0 +1,276 @@
+import atexit
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import types
+from pathlib import Path
+
+import config
+import metrics
+
+WRITE_SECONDS = metrics.histogram('tori_write_batch_seconds', 'Duration of writing one batch to the database')
+WRITES = metrics.counter('tori_writes_total', 'Rows written to the database or rejected by it', ['result'])
+WRITE_QUEUE = metrics.gauge('tori_write_queue_depth', 'Rows waiting to be written to the database',
+                            func=lambda: sum(w.backlog() for w in _writers.values()))
+
+# db methods and the fields of the items they read, so journaled rows can be replayed without the item classes
+_ITEM = ('toriid', 'description', 'price', 'date', 'imageurl', 'toriurl', 'category', 'location')
+FIELDS = {
+    'store_items': _ITEM,
+    'store_cars': _ITEM + ('car_ac', 'car_cruise', 'car_engine_heater', 'car_hook', 'car_fuel_expense', 'car_tax',
+                           'car_year', 'car_odo', 'car_fuel_type', 'car_gear', 'car_plate', 'car_type',
+                           'car_description_extra', 'car_info'),
+    'store_changes': ('toriid', 'price', 'date', 'change', 'prev_price'),
+}
+
+Write = collections.namedtuple('Write', ['seq', 'method', 'args', 'item'])
+
+
+class WriteBehind:
+    """
+    Writes items to the database from a background thread, so polling never waits for the database. Every
+    submitted row is first appended to an on-disk journal, then written in executemany batches of up to
+    batch_size rows. Rows not yet written when the process dies, or that do not fit into queue_size while the
+    database is unreachable, are replayed from the journal. A batch the database refuses is split in halves
+    until the offending rows are found, only those are dropped.
+    """
+    def __init__(self, db, journal=None, batch_size=1000, max_wait=1.0, queue_size=100000, fsync=True,
+                 max_backoff=60):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db = db
+        self.journal = Path(journal) if journal else None
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+        self.fsync = fsync
+        self.max_backoff = max_backoff
+        # tells errors meaning the database is unreachable from rows it refuses
+        self.unavailable = getattr(db.db, 'unavailable', lambda error: False)
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.seq = 0
+        self.applied = 0
+        # rows after applied are only in the journal until the writer reads them back
+        self.spilled = False
+        self.file = None
+        if self.journal:
+            self._open_journal()
+
+    def _open_journal(self):
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        unapplied = 0
+        if self.journal.exists():
+            for record in self._records():
+                if 'applied' in record:
+                    self.applied = max(self.applied, record['applied'])
+                else:
+                    self.seq = max(self.seq, record['seq'])
+            self.applied = min(self.applied, self.seq)
+            unapplied = self.seq - self.applied
+        self.file = open(self.journal, 'a+', encoding='utf-8')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell():
+            # a crash may have cut the last line short, start the next one on its own line
+            self.file.seek(self.file.tell() - 1)
+            if self.file.read(1) != '\n':
+                self.file.write('\n')
+        if unapplied:
+            self.logger.warning('replaying {} rows from {}'.format(unapplied, self.journal))
+            self.spilled = True
+            self._start()
+
+    def _records(self):
+        with open(self.journal, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def _replay(self):
+        # called with the lock held and nothing pending, loads the next unapplied rows of the journal
+        for record in self._records():
+            if 'seq' not in record or record['seq'] <= self.applied:
+                continue
+            if len(self.pending) >= self.queue_size:
+                return
+            item = types.SimpleNamespace(**record['item'])
+            if item.date is not None:
+                item.date = datetime.datetime.fromisoformat(item.date)
+            self.pending.append(Write(record['seq'], record['method'], tuple(record['args']), item))
+        self.spilled = False
+
+    def submit(self, method, items, *args):
+        """
+        Queues getattr(db, method)(*args, items), journaled before this returns.
+        """
+        fields = FIELDS[method]
+        rows = []
+        if self.file:
+            # serialized before any sequence number is taken, so a row that fails here leaves no gap
+            for item in items:
+                row = {field: getattr(item, field) for field in fields}
+                if row['date'] is not None:
+                    row['date'] = row['date'].isoformat()
+                rows.append(json.dumps(row))
+        call = '"method": {}, "args": {}'.format(json.dumps(method), json.dumps(args))
+        with self.lock:
+            writes = []
+            lines = []
+            for i, item in enumerate(items):
+                self.seq += 1
+                writes.append(Write(self.seq, method, args, item))
+                if rows:
+                    lines.append('{{"seq": {}, {}, "item": {}}}'.format(self.seq, call, rows[i]))
+            if lines:
+                self.file.write('\n'.join(lines) + '\n')
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            if self.spilled or (self.file and len(self.pending) + len(writes) > self.queue_size):
+                if not self.spilled:
+                    self.logger.warning('write queue full, keeping new rows in {} only'.format(self.journal))
+                self.spilled = True
+            else:
+                self.pending.extend(writes)
+            self.cond.notify()
+        self._start()
+
+    def backlog(self):
+        return self.seq - self.applied
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='db writer', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=60):
+        """
+        Writes what is queued and stops the writer. Rows it could not write stay in the journal.
+        """
+        with self.lock:
+            thread = self.thread
+            self.stopping.set()
+            self.cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _next_batch(self):
+        with self.lock:
+            while not self.pending and not self.spilled and not self.stopping.is_set():
+                self.cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.pending) < self.batch_size and not self.spilled and not self.stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if not self.pending and self.spilled:
+                self._replay()
+            return [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if self.stopping.is_set():
+                    break
+                continue
+            backoff = 1
+            while True:
+                try:
+                    with WRITE_SECONDS.time():
+                        self._write(batch)
+                    break
+                except Exception as e:
+                    # _write_isolating lets only unavailable errors through
+                    if self.stopping.is_set() and self.file:
+                        self.logger.warning('database unavailable ({}), {} rows left in the journal'.format(
+                            e, self.backlog()))
+                        return
+                    self.logger.warning('database unavailable ({}), retrying in {} s'.format(e, backoff))
+                    # without a journal keep trying until stop() gives up waiting
+                    if self.stopping.is_set():
+                        time.sleep(backoff)
+                    else:
+                        self.stopping.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            self._applied(batch[-1].seq)
+
+    def _applied(self, seq):
+        with self.lock:
+            self.applied = seq
+            if not self.file:
+                return
+            if not self.pending and not self.spilled and self.applied == self.seq:
+                self.file.truncate(0)
+            else:
+                self.file.write(json.dumps({'applied': seq}) + '\n')
+                self.file.flush()
+
+    def _write(self, batch):
+        # consecutive rows for the same call go together, so a row is never written before an earlier one
+        start = 0
+        for i in range(1, len(batch) + 1):
+            if i == len(batch) or batch[i][1:3] != batch[start][1:3]:
+                self._write_isolating(batch[start:i])
+                start = i
+
+    def _write_isolating(self, writes):
+        method, args = writes[0].method, writes[0].args
+        try:
+            getattr(self.db, method)(*args, [w.item for w in writes])
+            WRITES.inc(len(writes), result='written')
+        except Exception as e:
+            if self.unavailable(e):
+                raise
+            if len(writes) == 1:
+                self.logger.error('{} rejected toriid {}'.format(method, writes[0].item.toriid))
+                self.logger.error(traceback.format_exc())
+                WRITES.inc(result='rejected')
+                return
+        else:
+            return
+        middle = len(writes) // 2
+        self._write_isolating(writes[:middle])
+        self._write_isolating(writes[middle:])
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get(db) -> WriteBehind:
+    """
+    The writer of db, created on first use, None when write_behind is disabled.
+    """
+    if not config.write_behind:
+        return None
+    with _writers_lock:
+        if id(db) not in _writers:
+            journal = Path(config.journal_dir, db.__class__.__name__ + '.journal') if config.journal_dir else None
+            _writers[id(db)] = WriteBehind(db, journal, batch_size=config.write_batch, max_wait=config.write_wait,
+                                           queue_size=config.write_queue, fsync=config.journal_fsync)
+            atexit.register(_writers[id(db)].stop)
+        return _writers[id(db)]
+
+
+def stop_all(timeout=60):
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.stop(timeout)